@@ -0,0 +1,245 @@
+# Air Quality Index Engine
+# Computes US EPA AQI and EU CAQI from pollutant concentrations, batched over many readings
+
+import math
+import numpy as np
+
+# Pollutant columns of the concentration matrix (OpenWeatherMap component names, µg/m³)
+POLLUTANTS = ('pm2_5', 'pm10', 'o3', 'no2', 'so2', 'co')
+
+# µg/m³ -> ppb at 25°C and 1 atm: ppb = µg/m³ * 24.45 / molecular weight
+MOLAR_VOLUME = 24.45
+MOLECULAR_WEIGHTS = {'o3': 48.00, 'no2': 46.01, 'so2': 64.07, 'co': 28.01}
+
+# US EPA breakpoints: pollutant -> (unit, truncation decimals, [(c_lo, c_hi, i_lo, i_hi), ...])
+# PM2.5 uses the 2024 revision. O3 uses the 8-hour table, with the 1-hour table for the hazardous band.
+US_EPA_BREAKPOINTS = {
+    'pm2_5': ('µg/m³', 1, [
+        (0.0, 9.0, 0, 50), (9.1, 35.4, 51, 100), (35.5, 55.4, 101, 150),
+        (55.5, 125.4, 151, 200), (125.5, 225.4, 201, 300), (225.5, 325.4, 301, 500),
+    ]),
+    'pm10': ('µg/m³', 0, [
+        (0, 54, 0, 50), (55, 154, 51, 100), (155, 254, 101, 150),
+        (255, 354, 151, 200), (355, 424, 201, 300), (425, 604, 301, 500),
+    ]),
+    'o3': ('ppm', 3, [
+        (0.000, 0.054, 0, 50), (0.055, 0.070, 51, 100), (0.071, 0.085, 101, 150),
+        (0.086, 0.105, 151, 200), (0.106, 0.200, 201, 300), (0.405, 0.604, 301, 500),
+    ]),
+    'no2': ('ppb', 0, [
+        (0, 53, 0, 50), (54, 100, 51, 100), (101, 360, 101, 150),
+        (361, 649, 151, 200), (650, 1249, 201, 300), (1250, 2049, 301, 500),
+    ]),
+    'so2': ('ppb', 0, [
+        (0, 35, 0, 50), (36, 75, 51, 100), (76, 185, 101, 150),
+        (186, 304, 151, 200), (305, 604, 201, 300), (605, 1004, 301, 500),
+    ]),
+    'co': ('ppm', 1, [
+        (0.0, 4.4, 0, 50), (4.5, 9.4, 51, 100), (9.5, 12.4, 101, 150),
+        (12.5, 15.4, 151, 200), (15.5, 30.4, 201, 300), (30.5, 50.4, 301, 500),
+    ]),
+}
+
+US_EPA_CATEGORIES = [
+    (50, 'Good'),
+    (100, 'Moderate'),
+    (150, 'Unhealthy for Sensitive Groups'),
+    (200, 'Unhealthy'),
+    (300, 'Very Unhealthy'),
+    (500, 'Hazardous'),
+]
+
+# EU CAQI hourly background grid (µg/m³); index 0-100, extrapolated above 100
+EU_CAQI_GRID = {
+    'pm2_5': [0, 15, 30, 55, 110],
+    'pm10': [0, 25, 50, 90, 180],
+    'o3': [0, 60, 120, 180, 240],
+    'no2': [0, 50, 100, 200, 400],
+    'so2': [0, 50, 100, 350, 500],
+    'co': [0, 5000, 7500, 10000, 20000],
+}
+EU_CAQI_INDEX = [0, 25, 50, 75, 100]
+
+EU_CAQI_CATEGORIES = [
+    (25, 'Very Low'),
+    (50, 'Low'),
+    (75, 'Medium'),
+    (100, 'High'),
+    (math.inf, 'Very High'),
+]
+
+
+def _convert_units(pollutant, concentration):
+    # Convert µg/m³ to the unit of the US EPA breakpoint table (works on scalars and arrays)
+    unit = US_EPA_BREAKPOINTS[pollutant][0]
+    if unit == 'µg/m³':
+        return concentration
+    ppb = concentration * MOLAR_VOLUME / MOLECULAR_WEIGHTS[pollutant]
+    return ppb / 1000 if unit == 'ppm' else ppb
+
+
+def _category(value, categories):
+    if value is None:
+        return None
+    for upper, name in categories:
+        if value <= upper:
+            return name
+    return categories[-1][1]
+
+
+def _unit_factors():
+    # Per-pollutant multiplier from µg/m³ to the US EPA table unit
+    return np.array([float(_convert_units(pollutant, 1.0)) for pollutant in POLLUTANTS])
+
+
+def _epa_tables():
+    # (pollutants x bands) arrays of c_lo, c_hi, i_lo, i_hi
+    tables = [US_EPA_BREAKPOINTS[pollutant][2] for pollutant in POLLUTANTS]
+    return tuple(np.array([[band[field] for band in table] for table in tables], dtype=float) for field in range(4))
+
+
+class AQIIndexEngine:
+    # Sub-indices for every (reading, pollutant) cell are computed with whole-matrix
+    # array operations, so the current reading and all forecast hours cost one pass
+
+    UNIT_FACTORS = _unit_factors()
+    TRUNCATION_SCALE = np.array([10.0 ** US_EPA_BREAKPOINTS[pollutant][1] for pollutant in POLLUTANTS])
+    EPA_C_LO, EPA_C_HI, EPA_I_LO, EPA_I_HI = _epa_tables()
+    CAQI_GRID = np.array([EU_CAQI_GRID[pollutant] for pollutant in POLLUTANTS], dtype=float)
+    CAQI_INDEX = np.array(EU_CAQI_INDEX, dtype=float)
+
+    @staticmethod
+    def concentration_matrix(components_list):
+        # Build a (n, len(POLLUTANTS)) float matrix; missing pollutants become NaN
+        rows = [[components.get(pollutant) for pollutant in POLLUTANTS] for components in components_list]
+        return np.array(rows, dtype=float).reshape(len(rows), len(POLLUTANTS))
+
+    @classmethod
+    def us_epa_sub_indices(cls, matrix):
+        # Piecewise-linear US EPA sub-index for every cell of the matrix
+        valid = ~np.isnan(matrix)
+        concentration = np.maximum(np.where(valid, matrix, 0), 0) * cls.UNIT_FACTORS
+
+        # EPA truncates concentrations to the table precision (epsilon guards float error)
+        concentration = np.floor(concentration * cls.TRUNCATION_SCALE + 1e-9) / cls.TRUNCATION_SCALE
+
+        # Band = last breakpoint whose lower bound is <= the concentration
+        band = (concentration[:, :, None] >= cls.EPA_C_LO[None, :, :]).sum(axis=2) - 1
+        band = np.maximum(band, 0)
+        column = np.arange(len(POLLUTANTS))[None, :]
+        c_lo, c_hi = cls.EPA_C_LO[column, band], cls.EPA_C_HI[column, band]
+        i_lo, i_hi = cls.EPA_I_LO[column, band], cls.EPA_I_HI[column, band]
+
+        index = (i_hi - i_lo) / (c_hi - c_lo) * (concentration - c_lo) + i_lo
+        # Concentrations between bands or above the table take the band's upper index
+        index = np.where(concentration > c_hi, i_hi, index)
+
+        return np.where(valid, np.floor(index + 0.5), np.nan)
+
+    @classmethod
+    def eu_caqi_sub_indices(cls, matrix):
+        # Piecewise-linear EU CAQI sub-index; the top segment is extrapolated past 100
+        valid = ~np.isnan(matrix)
+        concentration = np.maximum(np.where(valid, matrix, 0), 0)
+
+        segments = cls.CAQI_GRID.shape[1] - 1
+        segment = (concentration[:, :, None] > cls.CAQI_GRID[None, :, 1:-1]).sum(axis=2)
+        column = np.arange(len(POLLUTANTS))[None, :]
+        g_lo, g_hi = cls.CAQI_GRID[column, segment], cls.CAQI_GRID[column, segment + 1]
+        i_lo, i_hi = cls.CAQI_INDEX[segment], cls.CAQI_INDEX[np.minimum(segment + 1, segments)]
+
+        index = i_lo + (concentration - g_lo) / (g_hi - g_lo) * (i_hi - i_lo)
+
+        return np.where(valid, np.round(index), np.nan)
+
+    @staticmethod
+    def _overall(sub_indices):
+        # Overall index is the worst sub-index; rows without any pollutant stay NaN / -1
+        has_value = ~np.all(np.isnan(sub_indices), axis=1)
+        filled = np.where(np.isnan(sub_indices), -np.inf, sub_indices)
+        overall = np.where(has_value, filled.max(axis=1), np.nan)
+        dominant = np.where(has_value, filled.argmax(axis=1), -1)
+        return overall, dominant
+
+    @classmethod
+    def compute(cls, components_list):
+        # Batched computation for a list of OpenWeatherMap `components` dicts
+        matrix = cls.concentration_matrix(components_list)
+        result = {}
+        for scale, sub_indices in (
+            ('us_epa', cls.us_epa_sub_indices(matrix)),
+            ('eu_caqi', cls.eu_caqi_sub_indices(matrix)),
+        ):
+            overall, dominant = cls._overall(sub_indices)
+            result[scale] = {'sub_indices': sub_indices, 'value': overall, 'dominant': dominant}
+        return result
+
+    @staticmethod
+    def value_at(result, scale, row):
+        # Overall index for one row as a plain int (None when unavailable)
+        value = result[scale]['value'][row]
+        return None if np.isnan(value) else int(value)
+
+    @classmethod
+    def describe(cls, result, row):
+        # JSON-ready index details for one row of a compute() result
+        description = {}
+        for scale, categories in (('us_epa', US_EPA_CATEGORIES), ('eu_caqi', EU_CAQI_CATEGORIES)):
+            value = cls.value_at(result, scale, row)
+            dominant = int(result[scale]['dominant'][row])
+            description[scale] = {
+                'value': value,
+                'category': _category(value, categories),
+                'dominant_pollutant': POLLUTANTS[dominant] if dominant >= 0 else None,
+                'sub_indices': {
+                    pollutant: int(sub_index)
+                    for pollutant, sub_index in zip(POLLUTANTS, result[scale]['sub_indices'][row])
+                    if not np.isnan(sub_index)
+                },
+            }
+        return description
+
+    @staticmethod
+    def compute_naive(components_list):
+        # Reference per-row, per-pollutant implementation; used to verify and benchmark compute()
+        results = []
+        for components in components_list:
+            us_epa = {}
+            eu_caqi = {}
+            for pollutant in POLLUTANTS:
+                value = components.get(pollutant)
+                if value is None:
+                    continue
+                value = max(value, 0)
+
+                _, decimals, table = US_EPA_BREAKPOINTS[pollutant]
+                scale = 10 ** decimals
+                concentration = math.floor(_convert_units(pollutant, value) * scale + 1e-9) / scale
+                band = table[0]
+                for candidate in table:
+                    if concentration >= candidate[0]:
+                        band = candidate
+                c_lo, c_hi, i_lo, i_hi = band
+                if concentration > c_hi:
+                    index = i_hi
+                else:
+                    index = (i_hi - i_lo) / (c_hi - c_lo) * (concentration - c_lo) + i_lo
+                us_epa[pollutant] = math.floor(index + 0.5)
+
+                grid = EU_CAQI_GRID[pollutant]
+                if value > grid[-1]:
+                    slope = (EU_CAQI_INDEX[-1] - EU_CAQI_INDEX[-2]) / (grid[-1] - grid[-2])
+                    index = EU_CAQI_INDEX[-1] + (value - grid[-1]) * slope
+                else:
+                    for position in range(1, len(grid)):
+                        if value <= grid[position]:
+                            fraction = (value - grid[position - 1]) / (grid[position] - grid[position - 1])
+                            index = EU_CAQI_INDEX[position - 1] + fraction * (EU_CAQI_INDEX[position] - EU_CAQI_INDEX[position - 1])
+                            break
+                eu_caqi[pollutant] = round(index)
+
+            results.append({
+                'us_epa': max(us_epa.values()) if us_epa else None,
+                'eu_caqi': max(eu_caqi.values()) if eu_caqi else None,
+            })
+        return results
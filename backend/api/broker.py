@@ -0,0 +1,158 @@
+# Update Broker for Air Quality Streams
+# Fans out cached city updates to stream subscribers (Redis pub/sub or in-process)
+
+from django.conf import settings
+import asyncio
+import json
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _RedisSubscription:
+    # One pub/sub connection per event loop (i.e. per worker process), shared by
+    # every stream it serves; a channel is subscribed while it has local listeners
+    RETRY_DELAY = 1  # seconds before reading again after a Redis error
+
+    def __init__(self, on_message):
+        import redis.asyncio as aioredis
+
+        self.client = aioredis.from_url(settings.REDIS_URL)
+        self.pubsub = self.client.pubsub()
+        self.on_message = on_message
+        self.listeners = {}  # channel -> number of local listeners
+        self.lock = asyncio.Lock()
+        self.reader = None
+
+    async def add(self, channels):
+        async with self.lock:
+            new_channels = [channel for channel in channels if channel not in self.listeners]
+            if new_channels:
+                await self.pubsub.subscribe(*new_channels)
+            for channel in channels:
+                self.listeners[channel] = self.listeners.get(channel, 0) + 1
+            if self.reader is None or self.reader.done():
+                self.reader = asyncio.create_task(self._read())
+
+    async def remove(self, channels):
+        async with self.lock:
+            idle_channels = []
+            for channel in channels:
+                self.listeners[channel] -= 1
+                if not self.listeners[channel]:
+                    del self.listeners[channel]
+                    idle_channels.append(channel)
+            if idle_channels:
+                await self.pubsub.unsubscribe(*idle_channels)
+
+    async def _read(self):
+        while True:
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except Exception as e:
+                logger.error(f"Update subscription error: {str(e)}")
+                await asyncio.sleep(self.RETRY_DELAY)
+                continue
+            if message:
+                channel = message['channel']
+                if isinstance(channel, bytes):
+                    channel = channel.decode('utf-8')
+                self.on_message(channel, message['data'])
+
+
+class UpdateBroker:
+    CHANNEL_PREFIX = 'aqi:updates:'
+
+    # Stream subscribers of this process: (loop, queue, channels). Without Redis,
+    # publish() delivers to them directly; with Redis, the shared subscription does
+    _local_subscribers = set()
+    _redis_subscriptions = {}  # event loop -> _RedisSubscription
+    _lock = threading.Lock()
+    _redis = None
+
+    @classmethod
+    def channel_for(cls, city_key):
+        # Pub/sub channel for a normalized city key
+        return f"{cls.CHANNEL_PREFIX}{city_key}"
+
+    @classmethod
+    def _get_redis(cls):
+        # Lazily create the synchronous publisher connection
+        if cls._redis is None:
+            from django_redis import get_redis_connection
+            cls._redis = get_redis_connection('default')
+        return cls._redis
+
+    @classmethod
+    def _get_subscription(cls):
+        loop = asyncio.get_running_loop()
+        with cls._lock:
+            if loop not in cls._redis_subscriptions:
+                cls._redis_subscriptions[loop] = _RedisSubscription(cls._deliver)
+            return cls._redis_subscriptions[loop]
+
+    @classmethod
+    def publish(cls, city_key, data):
+        # Publish a changed payload to every subscriber of the city
+        channel = cls.channel_for(city_key)
+        message = json.dumps({'city_key': city_key, 'data': data}, default=str)
+
+        if settings.REDIS_AVAILABLE:
+            try:
+                cls._get_redis().publish(channel, message)
+            except Exception as e:
+                logger.error(f"Update publish error: {str(e)}")
+            return
+
+        cls._deliver(channel, message)
+
+    @classmethod
+    def _deliver(cls, channel, message):
+        # Hand a message to the queue of every local subscriber of the channel
+        with cls._lock:
+            subscribers = list(cls._local_subscribers)
+
+        for loop, queue, channels in subscribers:
+            if channel in channels:
+                try:
+                    loop.call_soon_threadsafe(queue.put_nowait, message)
+                except RuntimeError:
+                    # Subscriber loop already closed
+                    pass
+
+    @staticmethod
+    def _decode(message):
+        if isinstance(message, bytes):
+            message = message.decode('utf-8')
+        return json.loads(message)
+
+    @classmethod
+    async def listen(cls, city_keys, idle_timeout):
+        # Async generator yielding update dicts; yields None once subscribed and
+        # after every idle_timeout seconds without an update
+        channels = frozenset(cls.channel_for(key) for key in city_keys)
+        queue = asyncio.Queue()
+        entry = (asyncio.get_running_loop(), queue, channels)
+        subscription = cls._get_subscription() if settings.REDIS_AVAILABLE else None
+
+        with cls._lock:
+            cls._local_subscribers.add(entry)
+        try:
+            if subscription is not None:
+                await subscription.add(channels)
+            try:
+                yield None
+                while True:
+                    try:
+                        message = await asyncio.wait_for(queue.get(), timeout=idle_timeout)
+                    except asyncio.TimeoutError:
+                        yield None
+                        continue
+                    yield cls._decode(message)
+            finally:
+                if subscription is not None:
+                    await subscription.remove(channels)
+        finally:
+            with cls._lock:
+                cls._local_subscribers.discard(entry)
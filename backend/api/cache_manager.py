@@ -1,15 +1,32 @@
 # Cache Manager for Air Quality Data
 # Handles caching with TTL and LRU eviction
+# Keys are namespaced by a generation number: invalidation is an atomic increment
+# and superseded entries simply age out through their TTLs
 
 from django.core.cache import cache
 from django.conf import settings
+from fnmatch import fnmatchcase
+import hashlib
+import json
 import time
 import logging
 
+from .broker import UpdateBroker
+from .spatial import SpatialIndex
+
 logger = logging.getLogger(__name__)
 
 
 class CacheManager:
+    # Generation counters (never expire)
+    GENERATION_KEY = 'ns_generation'
+    COUNTRY_GENERATION_PREFIX = 'ns_generation_country_'
+    NAME_PREFIX_GENERATION_PREFIX = 'ns_generation_prefix_'
+    
+    # Name prefix lengths with their own counter; every get/set reads one counter
+    # per length, and longer prefixes are invalidated through the longest one
+    PREFIX_LENGTHS = (1, 2, 3)
+    
     # Cache statistics
     _stats = {
         'hits': 0,
@@ -17,21 +34,127 @@ class CacheManager:
         'total_requests': 0,
     }
     
+    # Per-key hit counts (per process, like _stats)
+    _key_hits = {}
+    
+    # Last seen country per key, so get() can read every generation in one round trip;
+    # keys this process has not seen yet need a second one for the country counter
+    _countries = {}
+    
+    # Serialized-size histogram buckets for the inventory: (upper bound in bytes, label)
+    SIZE_BUCKETS = [
+        (1024, '<1KB'),
+        (4 * 1024, '1-4KB'),
+        (16 * 1024, '4-16KB'),
+        (64 * 1024, '16-64KB'),
+        (float('inf'), '>=64KB'),
+    ]
+    
     @staticmethod
-    def _normalize_key(city_name):
+    def _normalize_name(city_name):
+        return city_name.lower().strip().replace(' ', '_')
+    
+    @classmethod
+    def _normalize_key(cls, city_name):
         # Normalize city name for cache keys
-        return f"city_{city_name.lower().strip().replace(' ', '_')}"
+        return f"city_{cls._normalize_name(city_name)}"
+    
+    @classmethod
+    def key_for(cls, city_name):
+        # Public accessor for the normalized cache key of a city
+        return cls._normalize_key(city_name)
+    
+    @staticmethod
+    def _fingerprint(data):
+        # Hash of the payload content, ignoring cache bookkeeping fields
+        if not data:
+            return None
+        content = {k: v for k, v in data.items() if k not in ('cached', 'cached_at')}
+        encoded = json.dumps(content, sort_keys=True, default=str).encode('utf-8')
+        return hashlib.sha1(encoded).hexdigest()
+    
+    @classmethod
+    def _scope_keys(cls, cache_key, country):
+        # Generation keys that can invalidate an entry: its country and its short name prefixes
+        name = cache_key[len('city_'):]
+        keys = [
+            f"{cls.NAME_PREFIX_GENERATION_PREFIX}{name[:length]}"
+            for length in cls.PREFIX_LENGTHS
+            if length <= len(name)
+        ]
+        if country:
+            keys.append(f"{cls.COUNTRY_GENERATION_PREFIX}{country.lower()}")
+        return keys
+    
+    @classmethod
+    def _read_generations(cls, keys):
+        # Current value of each generation counter; unset scoped counters read as None
+        values = cache.get_many(keys)
+        generations = {key: values.get(key) for key in keys}
+        if cls.GENERATION_KEY in generations and not generations[cls.GENERATION_KEY]:
+            generations[cls.GENERATION_KEY] = cls._init_generation(cls.GENERATION_KEY)
+        return generations
+    
+    @staticmethod
+    def _init_generation(key):
+        # Start counters at wall-clock seconds so a lost counter can never rewind onto old
+        # keys or stamps; scoped counters are created by set(), so no entry is stamped
+        # against a counter that does not exist
+        cache.add(key, int(time.time()), None)
+        return cache.get(key)
+    
+    @classmethod
+    def _bump_generation(cls, key):
+        # Single atomic increment invalidates everything stamped with the old value
+        cls._init_generation(key)
+        return cache.incr(key)
     
     @classmethod
-    def get(cls, city_name):
-        # Get cached data for a city
+    def _unwrap(cls, entry, generations, allow_stale=False):
+        # Return the payload of a stored entry, or None if it is past its freshness
+        # window (unless allow_stale) or any of its scopes was invalidated
+        if entry is None:
+            return None
+        if not allow_stale and time.time() > entry['expires_at']:
+            return None
+        unknown = [key for key in entry['scopes'] if key not in generations]
+        if unknown:
+            generations.update(cls._read_generations(unknown))
+        for key, generation in entry['scopes'].items():
+            # A missing counter was evicted after set() created it; fail closed
+            if generations[key] != generation:
+                return None
+        return entry['data']
+    
+    @classmethod
+    def _read_entry(cls, cache_key, allow_stale=False):
+        # Read and validate one entry; known generations are fetched in a single round trip
+        scope_keys = cls._scope_keys(cache_key, cls._countries.get(cache_key))
+        generations = cls._read_generations([cls.GENERATION_KEY] + scope_keys)
+        entry = cache.get(cache_key, version=generations[cls.GENERATION_KEY])
+        data = cls._unwrap(entry, generations, allow_stale)
+        if data is not None:
+            cls._countries[cache_key] = data.get('country')
+        return data
+    
+    @classmethod
+    def get(cls, city_name, record_stats=True):
+        # Get fresh cached data for a city
+        if not record_stats:
+            try:
+                return cls._read_entry(cls._normalize_key(city_name))
+            except Exception as e:
+                logger.error(f"Cache retrieval error: {str(e)}")
+                return None
+        
         cls._stats['total_requests'] += 1
         cache_key = cls._normalize_key(city_name)
         
         try:
-            data = cache.get(cache_key)
+            data = cls._read_entry(cache_key)
             if data is not None:
                 cls._stats['hits'] += 1
+                cls._key_hits[cache_key] = cls._key_hits.get(cache_key, 0) + 1
                 logger.info(f"Cache HIT for city: {city_name}")
                 return data
             else:
@@ -43,6 +166,15 @@ class CacheManager:
             cls._stats['misses'] += 1
             return None
     
+    @classmethod
+    def get_stale(cls, city_name):
+        # Get cached data even if past its TTL (kept for CACHE_STALE_TTL more seconds)
+        try:
+            return cls._read_entry(cls._normalize_key(city_name), allow_stale=True)
+        except Exception as e:
+            logger.error(f"Cache retrieval error: {str(e)}")
+            return None
+    
     @classmethod
     def set(cls, city_name, data, timeout=None):
         # Store data in cache
@@ -52,32 +184,289 @@ class CacheManager:
             timeout = settings.CACHES['default']['TIMEOUT']
         
         try:
+            scope_keys = cls._scope_keys(cache_key, data.get('country'))
+            generations = cls._read_generations([cls.GENERATION_KEY] + scope_keys)
+            version = generations[cls.GENERATION_KEY]
+            for key in scope_keys:
+                if generations[key] is None:
+                    generations[key] = cls._init_generation(key)
+            
+            previous = cache.get(cache_key, version=version)
             data['cached_at'] = time.time()
-            cache.set(cache_key, data, timeout)
+            entry = {
+                'data': data,
+                'scopes': {key: generations[key] for key in scope_keys},
+                'expires_at': data['cached_at'] + timeout,
+            }
+            # Kept past its TTL so it can be served as stale data while a refresh runs
+            cache.set(cache_key, entry, timeout + settings.CACHE_STALE_TTL, version=version)
+            cls._countries[cache_key] = data.get('country')
             logger.info(f"Cached data for city: {city_name} (TTL: {timeout}s)")
         except Exception as e:
             logger.error(f"Cache storage error: {str(e)}")
+            return
+        
+        coordinates = data.get('coordinates')
+        if coordinates:
+            SpatialIndex.add(
+                cache_key, coordinates['lat'], coordinates['lon'], timeout + settings.CACHE_STALE_TTL
+            )
+        
+        # Push to stream subscribers only when the content actually changed
+        previous_data = previous['data'] if previous else None
+        if cls._fingerprint(previous_data) != cls._fingerprint(data):
+            UpdateBroker.publish(cache_key, data)
+    
+    @classmethod
+    def acquire_refresh_lock(cls, city_name, timeout):
+        # Atomically claim the right to refresh a city for `timeout` seconds
+        lock_key = f"refresh_lock_{cls._normalize_key(city_name)}"
+        try:
+            return cache.add(lock_key, 1, timeout)
+        except Exception as e:
+            logger.error(f"Refresh lock error: {str(e)}")
+            return False
     
     @classmethod
     def delete(cls, city_name):
         # Delete cached data for a city
         cache_key = cls._normalize_key(city_name)
         try:
-            cache.delete(cache_key)
+            version = cls._read_generations([cls.GENERATION_KEY])[cls.GENERATION_KEY]
+            cache.delete(cache_key, version=version)
             logger.info(f"Deleted cache for city: {city_name}")
         except Exception as e:
             logger.error(f"Cache deletion error: {str(e)}")
     
+    @classmethod
+    def iter_keys(cls, pattern='city_*', batch_size=100, version=None):
+        # Incrementally iterate cache keys matching pattern in the given (default: current) generation
+        if version is None:
+            version = cls._read_generations([cls.GENERATION_KEY])[cls.GENERATION_KEY]
+        
+        if hasattr(cache, 'iter_keys'):
+            # django-redis: cursor-based SCAN, never a full KEYS load
+            yield from cache.iter_keys(pattern, itersize=batch_size, version=version)
+            return
+        
+        # Local memory fallback: the store is an in-process dict of full keys
+        prefix = cache.make_key('', version=version)
+        for full_key in list(cache._cache.keys()):
+            key = full_key[len(prefix):]
+            if full_key.startswith(prefix) and fnmatchcase(key, pattern):
+                yield key
+    
+    @classmethod
+    def iter_entries(cls, batch_size=100):
+        # Yield (key, data) for every cached city, fetching values batch by batch
+        version = cls._read_generations([cls.GENERATION_KEY])[cls.GENERATION_KEY]
+        batch = []
+        for key in cls.iter_keys(batch_size=batch_size, version=version):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                yield from cls._get_batch(batch, version)
+                batch = []
+        if batch:
+            yield from cls._get_batch(batch, version)
+    
+    @classmethod
+    def get_by_keys(cls, keys):
+        # Fetch several entries by normalized key; does not count towards hit/miss stats.
+        # Returns (fresh data by key, keys that are gone: missing or invalidated);
+        # raises if the cache cannot be read, so callers never mistake an error for absence
+        keys = list(keys)
+        version = cls._read_generations([cls.GENERATION_KEY])[cls.GENERATION_KEY]
+        entries, generations = cls._read_batch(keys, version)
+        
+        cached = {}
+        gone = []
+        for key in keys:
+            entry = entries.get(key)
+            if cls._unwrap(entry, generations, allow_stale=True) is None:
+                gone.append(key)
+                continue
+            data = cls._unwrap(entry, generations)
+            if data is not None:
+                cached[key] = data
+        return cached, gone
+    
+    @classmethod
+    def _read_batch(cls, keys, version):
+        # Fetch stored entries and the generations of all their scopes in two round trips
+        entries = cache.get_many(keys, version=version)
+        scope_keys = {key for entry in entries.values() for key in entry['scopes']}
+        generations = cls._read_generations(list(scope_keys)) if scope_keys else {}
+        return entries, generations
+    
+    @classmethod
+    def _get_batch(cls, keys, version):
+        try:
+            entries, generations = cls._read_batch(keys, version)
+        except Exception as e:
+            logger.error(f"Cache batch retrieval error: {str(e)}")
+            return []
+        
+        # Keys may have expired or been invalidated between the scan and the fetch
+        batch = []
+        for key in keys:
+            data = cls._unwrap(entries.get(key), generations)
+            if data is not None:
+                batch.append((key, data))
+        return batch
+    
+    @classmethod
+    def current_generation(cls):
+        # Generation number used as the cache version of city keys
+        return cls._read_generations([cls.GENERATION_KEY])[cls.GENERATION_KEY]
+    
+    @classmethod
+    def _scan_page(cls, version, cursor, count):
+        # One page of the namespace: (next_cursor, [(key, serialized_size, ttl_seconds)])
+        # next_cursor is 0 once the namespace has been fully walked
+        if hasattr(cache, 'iter_keys'):
+            # django-redis: native SCAN cursor, sizes and TTLs in one pipeline
+            client = cache.client.get_client(write=False)
+            pattern = cache.client.make_pattern('city_*', version=version)
+            next_cursor, raw_keys = client.scan(cursor=cursor, match=pattern, count=count)
+            pipe = client.pipeline()
+            for raw_key in raw_keys:
+                pipe.strlen(raw_key)
+                pipe.pttl(raw_key)
+            results = pipe.execute()
+            page = []
+            for index, raw_key in enumerate(raw_keys):
+                size, pttl = results[2 * index], results[2 * index + 1]
+                ttl = round(pttl / 1000, 1) if pttl >= 0 else None
+                page.append((cache.client.reverse_key(raw_key.decode()), size, ttl))
+            return next_cursor, page
+        
+        # Local memory fallback: the cursor is an offset into the sorted key list
+        prefix = cache.make_key('', version=version)
+        full_keys = sorted(
+            full_key for full_key in list(cache._cache.keys())
+            if full_key.startswith(prefix) and fnmatchcase(full_key[len(prefix):], 'city_*')
+        )
+        now = time.time()
+        page = []
+        for full_key in full_keys[cursor:cursor + count]:
+            expires = cache._expire_info.get(full_key)
+            ttl = round(expires - now, 1) if expires is not None else None
+            page.append((full_key[len(prefix):], len(cache._cache.get(full_key, b'')), ttl))
+        next_cursor = cursor + count if cursor + count < len(full_keys) else 0
+        return next_cursor, page
+    
+    @staticmethod
+    def _backend_info():
+        # Store-wide memory and eviction figures
+        if hasattr(cache, 'iter_keys'):
+            client = cache.client.get_client(write=False)
+            try:
+                info = client.info()
+            except Exception as e:
+                # Some managed Redis deployments restrict INFO
+                logger.error(f"Redis INFO unavailable: {str(e)}")
+                info = {}
+            return {
+                'backend': 'redis',
+                'total_keys': client.dbsize(),
+                'used_memory_bytes': info.get('used_memory'),
+                'maxmemory_bytes': info.get('maxmemory'),
+                'maxmemory_policy': info.get('maxmemory_policy'),
+                'evicted_keys': info.get('evicted_keys'),
+                'expired_keys': info.get('expired_keys'),
+            }
+        
+        # LocMemCache culls silently, so evictions are not observable
+        return {
+            'backend': 'locmem',
+            'total_keys': len(cache._cache),
+            'max_entries': cache._max_entries,
+            'evicted_keys': None,
+            'expired_keys': None,
+        }
+    
+    @classmethod
+    def inventory(cls, cursor=0, count=100):
+        # One page of per-key size, TTL, age and hit data, with page totals and backend figures
+        version = cls.current_generation()
+        next_cursor, page = cls._scan_page(version, cursor, count)
+        entries, generations = cls._read_batch([key for key, _, _ in page], version) if page else ({}, {})
+        now = time.time()
+        
+        histogram = {label: 0 for _, label in cls.SIZE_BUCKETS}
+        keys = []
+        for key, size, ttl in page:
+            entry = entries.get(key)
+            data = entry['data'] if entry else {}
+            # Still stored, but a country or prefix invalidation has made it unreadable
+            invalidated = entry is not None and cls._unwrap(entry, generations, allow_stale=True) is None
+            cached_at = data.get('cached_at')
+            keys.append({
+                'key': key,
+                'city': data.get('city'),
+                'country': data.get('country'),
+                'size_bytes': size,
+                'ttl_seconds': ttl,
+                'fresh_for_seconds': round(entry['expires_at'] - now, 1) if entry and not invalidated else None,
+                'invalidated': invalidated,
+                'age_seconds': round(now - cached_at, 1) if cached_at else None,
+                'hits': cls._key_hits.get(key, 0),
+            })
+            for upper, label in cls.SIZE_BUCKETS:
+                if size < upper:
+                    histogram[label] += 1
+                    break
+        
+        return {
+            'generation': version,
+            'cursor': next_cursor,
+            'complete': next_cursor == 0,
+            'keys': keys,
+            'page_totals': {
+                'keys': len(keys),
+                'size_bytes': sum(item['size_bytes'] for item in keys),
+                'stale_keys': sum(
+                    1 for item in keys
+                    if item['fresh_for_seconds'] is not None and item['fresh_for_seconds'] < 0
+                ),
+                'invalidated_keys': sum(1 for item in keys if item['invalidated']),
+                'size_histogram': histogram,
+            },
+            'backend': cls._backend_info(),
+        }
+    
     @classmethod
     def clear_all(cls):
-        # Clear all cache
+        # Invalidate every city entry by moving to a new generation (no flush, no scan)
         try:
-            cache.clear()
+            generation = cls._bump_generation(cls.GENERATION_KEY)
             cls._stats = {'hits': 0, 'misses': 0, 'total_requests': 0}
-            logger.info("All cache cleared")
+            cls._key_hits = {}
+            logger.info(f"All cache invalidated (generation {generation})")
         except Exception as e:
             logger.error(f"Cache clear error: {str(e)}")
     
+    @classmethod
+    def invalidate_country(cls, country):
+        # Invalidate every city entry of a country code
+        try:
+            cls._bump_generation(f"{cls.COUNTRY_GENERATION_PREFIX}{country.strip().lower()}")
+            logger.info(f"Cache invalidated for country: {country}")
+        except Exception as e:
+            logger.error(f"Cache invalidation error: {str(e)}")
+    
+    @classmethod
+    def invalidate_prefix(cls, prefix):
+        # Invalidate every city entry whose normalized name starts with prefix.
+        # Prefixes longer than PREFIX_LENGTHS allow are cut down, which also
+        # invalidates other cities sharing the shorter prefix
+        scope = cls._normalize_name(prefix)[:max(cls.PREFIX_LENGTHS)]
+        try:
+            cls._bump_generation(f"{cls.NAME_PREFIX_GENERATION_PREFIX}{scope}")
+            logger.info(f"Cache invalidated for name prefix: {prefix} (scope: {scope})")
+        except Exception as e:
+            logger.error(f"Cache invalidation error: {str(e)}")
+    
     @classmethod
     def get_stats(cls):
         # Get cache statistics
@@ -96,5 +485,6 @@ class CacheManager:
     def reset_stats(cls):
         # Reset statistics
         cls._stats = {'hits': 0, 'misses': 0, 'total_requests': 0}
+        cls._key_hits = {}
         logger.info("Cache statistics reset")
 
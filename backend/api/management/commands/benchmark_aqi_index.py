@@ -0,0 +1,63 @@
+# Micro-benchmark: batched AQIIndexEngine.compute vs the naive per-row implementation
+
+from django.core.management.base import BaseCommand
+import random
+import time
+
+from api.aqi_index import AQIIndexEngine, POLLUTANTS
+
+# Upper bounds (µg/m³) for randomly generated concentrations
+CONCENTRATION_RANGES = {
+    'pm2_5': 400,
+    'pm10': 700,
+    'o3': 900,
+    'no2': 2500,
+    'so2': 2800,
+    'co': 60000,
+}
+
+
+class Command(BaseCommand):
+    help = 'Benchmark vectorized AQI index computation against a naive per-row loop'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=97, help='Readings per batch (97 = current + 96 forecast hours)')
+        parser.add_argument('--batches', type=int, default=100, help='Number of batches to time')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        batches = [
+            [
+                {pollutant: rng.uniform(0, CONCENTRATION_RANGES[pollutant]) for pollutant in POLLUTANTS}
+                for _ in range(options['rows'])
+            ]
+            for _ in range(options['batches'])
+        ]
+
+        start = time.perf_counter()
+        naive_results = [AQIIndexEngine.compute_naive(batch) for batch in batches]
+        naive_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        vector_results = [AQIIndexEngine.compute(batch) for batch in batches]
+        vector_time = time.perf_counter() - start
+
+        # Both implementations must agree before the timings mean anything
+        mismatches = 0
+        for naive, vector in zip(naive_results, vector_results):
+            for row, expected in enumerate(naive):
+                for scale in ('us_epa', 'eu_caqi'):
+                    if AQIIndexEngine.value_at(vector, scale, row) != expected[scale]:
+                        mismatches += 1
+
+        total_rows = options['rows'] * options['batches']
+        self.stdout.write(f"Rows: {total_rows} ({options['batches']} batches x {options['rows']})")
+        self.stdout.write(f"Naive:      {naive_time * 1000:.2f} ms ({naive_time / total_rows * 1e6:.2f} µs/row)")
+        self.stdout.write(f"Vectorized: {vector_time * 1000:.2f} ms ({vector_time / total_rows * 1e6:.2f} µs/row)")
+        self.stdout.write(f"Speedup:    {naive_time / vector_time:.1f}x")
+
+        if mismatches:
+            self.stderr.write(self.style.ERROR(f"{mismatches} index values differ between implementations"))
+        else:
+            self.stdout.write(self.style.SUCCESS('Results match'))
@@ -0,0 +1,62 @@
+# Worker process for the background refresh queue
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+import threading
+import signal
+import time
+
+from api.refresh_queue import RefreshQueue
+
+
+class Command(BaseCommand):
+    help = 'Process queued upstream refresh jobs with concurrent fetchers'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=settings.REFRESH_WORKER_CONCURRENCY,
+            help='Number of concurrent upstream fetchers'
+        )
+
+    def handle(self, *args, **options):
+        if not settings.REDIS_AVAILABLE:
+            raise CommandError(
+                'Redis is not available. Without Redis, refresh jobs run in-process in the web server.'
+            )
+
+        concurrency = options['concurrency']
+        if concurrency < 1:
+            raise CommandError('--concurrency must be at least 1')
+
+        stop_event = threading.Event()
+
+        def shutdown(signum, frame):
+            self.stdout.write('Stopping refresh worker...')
+            stop_event.set()
+
+        signal.signal(signal.SIGINT, shutdown)
+        signal.signal(signal.SIGTERM, shutdown)
+
+        workers = [
+            threading.Thread(target=RefreshQueue.work, args=(stop_event,), name=f"refresh-worker-{index}")
+            for index in range(concurrency)
+        ]
+        for worker in workers:
+            worker.start()
+
+        self.stdout.write(self.style.SUCCESS(f"Refresh worker started with {concurrency} fetchers"))
+
+        # Join in short steps so signals are handled promptly; the heartbeat keeps
+        # web processes from starting their own fetchers
+        next_heartbeat = 0
+        while any(worker.is_alive() for worker in workers):
+            if not stop_event.is_set() and time.monotonic() >= next_heartbeat:
+                try:
+                    RefreshQueue.heartbeat()
+                except Exception as e:
+                    self.stderr.write(f"Heartbeat error: {str(e)}")
+                next_heartbeat = time.monotonic() + RefreshQueue.HEARTBEAT_TTL / 3
+            for worker in workers:
+                worker.join(timeout=0.5)
@@ -0,0 +1,201 @@
+# Background Refresh Queue for Air Quality Data
+# Deduplicated upstream refresh jobs, processed outside the request thread
+# (Redis lists shared with the refresh_worker command, or in-process threads without Redis)
+
+from django.core.cache import cache
+from django.conf import settings
+import itertools
+import json
+import queue
+import threading
+import time
+import logging
+
+from .services import OpenWeatherService
+from .cache_manager import CacheManager
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshQueue:
+    # Redis lists; BRPOP drains the high priority list first
+    HIGH_PRIORITY_KEY = 'aqi:refresh:high'
+    LOW_PRIORITY_KEY = 'aqi:refresh:low'
+    POLL_INTERVAL = 0.1  # seconds between completion checks while waiting
+    
+    # Written by the refresh_worker command; without it, web processes fetch in-process
+    HEARTBEAT_KEY = 'refresh_worker_heartbeat'
+    HEARTBEAT_TTL = 15  # seconds
+
+    # In-process fallback used when Redis is not available
+    _local_queue = queue.PriorityQueue()
+    _local_sequence = itertools.count()
+    _local_workers = []
+    _lock = threading.Lock()
+    _redis = None
+
+    @classmethod
+    def _get_redis(cls):
+        if cls._redis is None:
+            from django_redis import get_redis_connection
+            cls._redis = get_redis_connection('default')
+        return cls._redis
+
+    @staticmethod
+    def _pending_key(city_name):
+        return f"refresh_pending_{CacheManager.key_for(city_name)}"
+
+    @staticmethod
+    def _error_key(city_name):
+        return f"refresh_error_{CacheManager.key_for(city_name)}"
+
+    @staticmethod
+    def _promoted_key(city_name):
+        return f"refresh_promoted_{CacheManager.key_for(city_name)}"
+
+    @staticmethod
+    def _claim_key(city_name):
+        return f"refresh_claim_{CacheManager.key_for(city_name)}"
+
+    @classmethod
+    def enqueue(cls, city_name, priority=False):
+        # Queue a refresh unless one is already pending for the same normalized city.
+        # Returns True if a new job was queued.
+        pending_key = cls._pending_key(city_name)
+        is_new = cache.add(pending_key, 1, settings.REFRESH_JOB_TTL)
+
+        if is_new:
+            cache.delete(cls._error_key(city_name))
+        if priority:
+            # A waiting user promotes an already queued job once; whichever copy is
+            # popped first does the work and the other is skipped
+            promoted = cache.add(cls._promoted_key(city_name), 1, settings.REFRESH_JOB_TTL)
+            if not is_new and not promoted:
+                return False
+        elif not is_new:
+            return False
+
+        cls._push(city_name, priority)
+        logger.info(f"Queued refresh for city: {city_name} (priority: {priority})")
+        return is_new
+
+    @classmethod
+    def heartbeat(cls):
+        # Called periodically by the refresh_worker command
+        cache.set(cls.HEARTBEAT_KEY, time.time(), cls.HEARTBEAT_TTL)
+
+    @classmethod
+    def worker_alive(cls):
+        return cache.get(cls.HEARTBEAT_KEY) is not None
+
+    @classmethod
+    def _push(cls, city_name, priority):
+        job = json.dumps({'city': city_name, 'queued_at': time.time()})
+
+        if settings.REDIS_AVAILABLE:
+            key = cls.HIGH_PRIORITY_KEY if priority else cls.LOW_PRIORITY_KEY
+            cls._get_redis().lpush(key, job)
+            if not cls._local_workers and not cls.worker_alive():
+                # No refresh_worker running (e.g. manual setup): fetch from this
+                # process instead of leaving every cache miss pending
+                logger.warning('No refresh worker heartbeat; starting in-process fetchers')
+                cls._ensure_local_workers()
+            return
+
+        cls._ensure_local_workers()
+        cls._local_queue.put((0 if priority else 1, next(cls._local_sequence), job))
+
+    @classmethod
+    def _pop(cls, timeout):
+        # Next job as (city_name, queued_at), or None after timeout seconds
+        if settings.REDIS_AVAILABLE:
+            item = cls._get_redis().brpop([cls.HIGH_PRIORITY_KEY, cls.LOW_PRIORITY_KEY], timeout=timeout)
+            job = item[1].decode('utf-8') if item else None
+        else:
+            try:
+                job = cls._local_queue.get(timeout=timeout)[2]
+            except queue.Empty:
+                job = None
+
+        if job is None:
+            return None
+        job = json.loads(job)
+        return job['city'], job['queued_at']
+
+    @classmethod
+    def wait(cls, city_name, timeout):
+        # Wait up to timeout seconds for a queued refresh.
+        # Returns the fresh data, None if still pending, or raises the upstream error.
+        pending_key = cls._pending_key(city_name)
+        error_key = cls._error_key(city_name)
+        deadline = time.monotonic() + timeout
+
+        while True:
+            status = cache.get_many([pending_key, error_key])
+            if error_key in status:
+                raise Exception(status[error_key])
+            if pending_key not in status:
+                return CacheManager.get(city_name, record_stats=False)
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(cls.POLL_INTERVAL)
+
+    @classmethod
+    def process(cls, city_name, queued_at=None):
+        # Fetch one city from upstream and store it; errors are kept briefly for waiters
+        pending_key = cls._pending_key(city_name)
+        claim_key = cls._claim_key(city_name)
+        if cache.get(pending_key) is None:
+            queued_for = time.time() - queued_at if queued_at is not None else 0
+            if queued_for >= settings.REFRESH_JOB_TTL:
+                # The pending marker expired while queued; the next request re-queues the city
+                logger.warning(
+                    f"Skipped refresh for city '{city_name}': queued for {queued_for:.0f}s, "
+                    f"longer than REFRESH_JOB_TTL ({settings.REFRESH_JOB_TTL}s)"
+                )
+            # Otherwise a duplicate of a job that already completed
+            return
+        if not cache.add(claim_key, 1, settings.REFRESH_JOB_TTL):
+            # Another fetcher is already working on this city
+            return
+
+        try:
+            weather_service = OpenWeatherService()
+            air_quality_data = weather_service.get_air_quality_by_city(city_name)
+            CacheManager.set(city_name, air_quality_data)
+            logger.info(f"Refreshed city: {city_name}")
+        except Exception as e:
+            logger.error(f"Refresh failed for city '{city_name}': {str(e)}")
+            cache.set(cls._error_key(city_name), str(e), settings.REFRESH_ERROR_TTL)
+        finally:
+            cache.delete_many([pending_key, cls._promoted_key(city_name), claim_key])
+
+    @classmethod
+    def work(cls, stop_event, poll_timeout=1):
+        # Worker loop: process jobs until stop_event is set
+        while not stop_event.is_set():
+            try:
+                job = cls._pop(poll_timeout)
+            except Exception as e:
+                logger.error(f"Refresh queue error: {str(e)}")
+                time.sleep(poll_timeout)
+                continue
+            if job:
+                cls.process(*job)
+
+    @classmethod
+    def _ensure_local_workers(cls):
+        # Start in-process fetchers on first use (local memory cache, or Redis without a worker)
+        with cls._lock:
+            if cls._local_workers:
+                return
+            stop_event = threading.Event()
+            for index in range(settings.REFRESH_WORKER_CONCURRENCY):
+                worker = threading.Thread(
+                    target=cls.work,
+                    args=(stop_event,),
+                    name=f"refresh-worker-{index}",
+                    daemon=True
+                )
+                worker.start()
+                cls._local_workers.append(worker)
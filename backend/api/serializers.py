@@ -2,6 +2,7 @@
 API Serializers for Air Quality Data
 """
 
+from django.conf import settings
 from rest_framework import serializers
 
 
@@ -33,6 +34,22 @@ class ForecastItemSerializer(serializers.Serializer):
     aqi = serializers.IntegerField()
     pm25 = serializers.FloatField()
     pm10 = serializers.FloatField()
+    us_epa_aqi = serializers.IntegerField(required=False, allow_null=True)
+    eu_caqi = serializers.IntegerField(required=False, allow_null=True)
+
+
+class IndexSerializer(serializers.Serializer):
+    """Serializer for a computed standard index (US EPA AQI or EU CAQI)"""
+    value = serializers.IntegerField(allow_null=True)
+    category = serializers.CharField(allow_null=True)
+    dominant_pollutant = serializers.CharField(allow_null=True)
+    sub_indices = serializers.DictField(child=serializers.IntegerField())
+
+
+class IndicesSerializer(serializers.Serializer):
+    """Serializer for the standard indices computed from concentrations"""
+    us_epa = IndexSerializer()
+    eu_caqi = IndexSerializer()
 
 
 class AirQualityDataSerializer(serializers.Serializer):
@@ -41,10 +58,12 @@ class AirQualityDataSerializer(serializers.Serializer):
     country = serializers.CharField()
     coordinates = CoordinatesSerializer()
     aqi = AQISerializer()
+    indices = IndicesSerializer(required=False)
     pollutants = serializers.DictField(child=PollutantSerializer())
     forecast = ForecastItemSerializer(many=True)
     timestamp = serializers.IntegerField()
     cached = serializers.BooleanField(default=False)
+    stale = serializers.BooleanField(required=False)
     cached_at = serializers.FloatField(required=False)
 
 
@@ -84,3 +103,101 @@ class CitySearchSerializer(serializers.Serializer):
         if len(value) < 2:
             raise serializers.ValidationError("City name must be at least 2 characters")
         return value
+
+
+class CityStreamSerializer(serializers.Serializer):
+    """Serializer for stream subscription input validation"""
+    cities = serializers.CharField(
+        max_length=1000,
+        required=True,
+        error_messages={
+            'required': 'At least one city is required',
+            'blank': 'City list cannot be empty',
+        }
+    )
+    
+    def validate_cities(self, value):
+        """Split the comma-separated list into unique, validated city names"""
+        cities = []
+        for city in value.split(','):
+            city = city.strip()
+            if not city:
+                continue
+            if len(city) < 2 or len(city) > 100:
+                raise serializers.ValidationError(f"Invalid city name: '{city}'")
+            if city.lower() not in [c.lower() for c in cities]:
+                cities.append(city)
+        if not cities:
+            raise serializers.ValidationError("At least one city is required")
+        if len(cities) > settings.STREAM_MAX_CITIES:
+            raise serializers.ValidationError(
+                f"Cannot subscribe to more than {settings.STREAM_MAX_CITIES} cities"
+            )
+        return cities
+
+
+class CacheExportSerializer(serializers.Serializer):
+    """Serializer for cache export input validation"""
+    format = serializers.ChoiceField(
+        choices=['ndjson', 'csv'],
+        default='ndjson',
+        error_messages={
+            'invalid_choice': 'Export format must be one of: ndjson, csv'
+        }
+    )
+
+
+class NearbySearchSerializer(serializers.Serializer):
+    """Serializer for nearest-cities query validation"""
+    lat = serializers.FloatField(min_value=-90, max_value=90)
+    lon = serializers.FloatField(min_value=-180, max_value=180)
+    k = serializers.IntegerField(min_value=1, max_value=100, default=10)
+
+
+class BoundingBoxSerializer(serializers.Serializer):
+    """Serializer for bounding-box query validation"""
+    min_lat = serializers.FloatField(min_value=-90, max_value=90)
+    min_lon = serializers.FloatField(min_value=-180, max_value=180)
+    max_lat = serializers.FloatField(min_value=-90, max_value=90)
+    max_lon = serializers.FloatField(min_value=-180, max_value=180)
+    limit = serializers.IntegerField(min_value=1, max_value=500, default=100)
+    
+    def validate(self, attrs):
+        """Check latitude ordering; min_lon > max_lon means the box crosses the antimeridian"""
+        if attrs['min_lat'] > attrs['max_lat']:
+            raise serializers.ValidationError("min_lat must not be greater than max_lat")
+        return attrs
+
+
+class LocationSummarySerializer(serializers.Serializer):
+    """Serializer for a cached city summary returned by spatial queries"""
+    city_key = serializers.CharField()
+    city = serializers.CharField()
+    country = serializers.CharField()
+    coordinates = CoordinatesSerializer()
+    aqi = AQISerializer()
+    distance_km = serializers.FloatField(required=False)
+    timestamp = serializers.IntegerField(required=False)
+    cached_at = serializers.FloatField(required=False)
+
+
+class CacheInvalidateSerializer(serializers.Serializer):
+    """Serializer for cache invalidation input validation"""
+    all = serializers.BooleanField(required=False, default=False)
+    country = serializers.CharField(required=False, min_length=2, max_length=3)
+    prefix = serializers.CharField(required=False, min_length=1, max_length=100)
+    
+    def validate(self, attrs):
+        """Require exactly one invalidation scope"""
+        scopes = [name for name in ('country', 'prefix') if attrs.get(name)]
+        if attrs.get('all'):
+            scopes.append('all')
+        if len(scopes) != 1:
+            raise serializers.ValidationError("Provide exactly one of: all, country, prefix")
+        return attrs
+
+
+class CacheInventorySerializer(serializers.Serializer):
+    """Serializer for cache inventory pagination input"""
+    cursor = serializers.IntegerField(min_value=0, default=0)
+    count = serializers.IntegerField(min_value=1, max_value=1000, default=100)
@@ -3,11 +3,80 @@
 
 import requests
 from django.conf import settings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import math
+import threading
+import time
 import logging
 
+from .aqi_index import AQIIndexEngine
+
 logger = logging.getLogger(__name__)
 
 
+class LatencyTracker:
+    # Rolling window of recent upstream latencies (seconds) for one endpoint; timed-out
+    # calls are recorded at their elapsed time as a lower bound of the real latency
+    
+    def __init__(self, window):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+    
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+    
+    def percentile(self, q, min_samples):
+        # Nearest-rank percentile, or None until enough samples were observed
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < max(min_samples, 1):
+            return None
+        rank = max(1, math.ceil(q / 100 * len(samples)))
+        return samples[rank - 1]
+
+
+class RateBudget:
+    # Token bucket for upstream calls; primary calls always proceed and consume
+    # a token, hedged duplicates are only sent while tokens remain
+    
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def consume(self):
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+    
+    def try_acquire(self):
+        with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class Deadline:
+    # Overall time budget shared by every upstream call made for one request
+    
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+    
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+
 class OpenWeatherService:
     
     # AQI Level interpretations based on index value
@@ -28,32 +97,148 @@ class OpenWeatherService:
         'so2': 40,
     }
     
-    def __init__(self):
+    # Upstream call state shared by all instances in this process
+    _latency = {}
+    _rate_budget = None
+    _executor = None
+    _state_lock = threading.Lock()
+    _hedge_stats = {'sent': 0, 'won': 0, 'skipped_budget': 0}
+    
+    def __init__(self, deadline=None):
         self.api_key = settings.OPENWEATHER_API_KEY
         self.geo_url = settings.OPENWEATHER_GEO_URL
         self.pollution_url = settings.OPENWEATHER_POLLUTION_URL
-        self.timeout = 10  # seconds
+        self.timeout = settings.UPSTREAM_TIMEOUT_MAX  # seconds, upper bound for one call
+        self.deadline = deadline
+    
+    @classmethod
+    def _tracker_for(cls, url):
+        with cls._state_lock:
+            if url not in cls._latency:
+                cls._latency[url] = LatencyTracker(settings.UPSTREAM_LATENCY_WINDOW)
+            return cls._latency[url]
+    
+    @classmethod
+    def _get_rate_budget(cls):
+        with cls._state_lock:
+            if cls._rate_budget is None:
+                cls._rate_budget = RateBudget(settings.UPSTREAM_RATE_LIMIT_PER_MINUTE)
+            return cls._rate_budget
+    
+    @classmethod
+    def _get_executor(cls):
+        with cls._state_lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(
+                    max_workers=settings.UPSTREAM_MAX_CONCURRENCY,
+                    thread_name_prefix='upstream'
+                )
+            return cls._executor
+    
+    @classmethod
+    def _count_hedge(cls, outcome):
+        with cls._state_lock:
+            cls._hedge_stats[outcome] += 1
+    
+    @classmethod
+    def get_hedge_stats(cls):
+        # Hedged request counters of this process: sent, won and skipped for lack of rate budget
+        with cls._state_lock:
+            return dict(cls._hedge_stats)
+    
+    @classmethod
+    def reset_hedge_stats(cls):
+        with cls._state_lock:
+            cls._hedge_stats = {'sent': 0, 'won': 0, 'skipped_budget': 0}
+    
+    def _adaptive_timeout(self, tracker):
+        # A multiple of the observed p99, clamped to [MIN, MAX]; MAX until enough samples exist
+        p99 = tracker.percentile(99, settings.UPSTREAM_LATENCY_MIN_SAMPLES)
+        if p99 is None:
+            return self.timeout
+        adaptive = p99 * settings.UPSTREAM_TIMEOUT_MULTIPLIER
+        return min(self.timeout, max(settings.UPSTREAM_TIMEOUT_MIN, adaptive))
+    
+    @staticmethod
+    def _send(url, params, timeout):
+        # One HTTP attempt; returns (json, latency in seconds)
+        started = time.monotonic()
+        response = requests.get(url, params=params, timeout=timeout)
+        response.raise_for_status()
+        return response.json(), time.monotonic() - started
     
     def _make_request(self, url, params):
-        print('inside _make_request apikey -->', self.api_key)
-        # Make HTTP request to OpenWeatherMap API
+        # Make HTTP request to OpenWeatherMap API, with an adaptive timeout bounded by the
+        # request deadline and an optional hedged duplicate once the call passes its p95
         params['appid'] = self.api_key
         
+        tracker = self._tracker_for(url)
+        adaptive_timeout = timeout = self._adaptive_timeout(tracker)
+        if self.deadline is not None:
+            remaining = self.deadline.remaining()
+            if remaining <= 0:
+                logger.error(f"Request deadline exceeded before calling URL: {url}")
+                raise Exception("API request timed out. Please try again.")
+            timeout = min(timeout, remaining)
+        
+        budget = self._get_rate_budget()
+        executor = self._get_executor()
+        started = time.monotonic()
+        
+        budget.consume()
+        primary = executor.submit(self._send, url, params, timeout)
+        futures = {primary}
+        
+        hedge_after = None
+        if settings.UPSTREAM_HEDGING_ENABLED:
+            hedge_after = tracker.percentile(95, settings.UPSTREAM_LATENCY_MIN_SAMPLES)
+        
+        if hedge_after is not None and hedge_after < timeout:
+            done, _ = wait(futures, timeout=hedge_after)
+            if not done:
+                if budget.try_acquire():
+                    futures.add(executor.submit(self._send, url, params, timeout - hedge_after))
+                    self._count_hedge('sent')
+                    logger.info(f"Hedged request for URL: {url} after {hedge_after:.3f}s")
+                else:
+                    self._count_hedge('skipped_budget')
+        
+        error = None
+        pending = futures
+        while pending:
+            remaining = timeout - (time.monotonic() - started)
+            done, pending = wait(pending, timeout=max(remaining, 0), return_when=FIRST_COMPLETED)
+            if not done:
+                error = requests.exceptions.Timeout()
+                break
+            for future in done:
+                if future.exception() is None:
+                    data, latency = future.result()
+                    tracker.record(latency)
+                    if future is not primary:
+                        self._count_hedge('won')
+                    return data
+                error = future.exception()
+        
         try:
-            response = requests.get(url, params=params, timeout=self.timeout)
-            response.raise_for_status()
-            return response.json()
+            raise error
         except requests.exceptions.Timeout:
             logger.error(f"Request timeout for URL: {url}")
+            if timeout >= adaptive_timeout:
+                # Censored sample: without it the window only ever holds fast calls and
+                # the timeout could never grow back after upstream slows down. Calls cut
+                # short by the request deadline say nothing about upstream latency
+                tracker.record(time.monotonic() - started)
             raise Exception("API request timed out. Please try again.")
         except requests.exceptions.HTTPError as e:
-            if response.status_code == 401:
+            status_code = e.response.status_code
+            if status_code == 401:
                 raise Exception("Invalid API key. Please check your configuration.")
-            elif response.status_code == 404:
+            elif status_code == 404:
                 raise Exception("City not found. Please check the city name.")
             else:
                 logger.error(f"HTTP error: {e}")
-                raise Exception(f"API error: {response.status_code}")
+                raise Exception(f"API error: {status_code}")
         except requests.exceptions.RequestException as e:
             logger.error(f"Request error: {e}")
             raise Exception("Unable to connect to weather service. Please try again later.")
@@ -132,6 +317,17 @@ class OpenWeatherService:
     
     def get_air_quality_by_city(self, city_name):
         # Get comprehensive air quality data for a city
+        # All upstream calls share one overall deadline unless the caller passed one
+        if self.deadline is not None:
+            return self._fetch_air_quality(city_name)
+        
+        self.deadline = Deadline(settings.UPSTREAM_REQUEST_DEADLINE)
+        try:
+            return self._fetch_air_quality(city_name)
+        finally:
+            self.deadline = None
+    
+    def _fetch_air_quality(self, city_name):
         # Get coordinates
         lat, lon, city, country = self.get_coordinates(city_name)
         
@@ -151,14 +347,22 @@ class OpenWeatherService:
         # Format pollutant data
         pollutants = self._format_pollutant_data(current_data['components'])
         
+        # Standard indices for the current reading and every forecast hour in one batch
+        forecast_data = forecast_data[:96]  # Limit to 96 hours
+        indices = AQIIndexEngine.compute(
+            [current_data['components']] + [item['components'] for item in forecast_data]
+        )
+        
         # Format forecast (take hourly data for next 96 hours - 4 days)
         forecast = []
-        for item in forecast_data[:96]:  # Limit to 96 hours
+        for row, item in enumerate(forecast_data, start=1):
             forecast.append({
                 'timestamp': item['dt'],
                 'aqi': item['main']['aqi'],
                 'pm25': item['components'].get('pm2_5', 0),
                 'pm10': item['components'].get('pm10', 0),
+                'us_epa_aqi': AQIIndexEngine.value_at(indices, 'us_epa', row),
+                'eu_caqi': AQIIndexEngine.value_at(indices, 'eu_caqi', row),
             })
         
         return {
@@ -173,6 +377,7 @@ class OpenWeatherService:
                 'level': aqi_info['level'],
                 'description': aqi_info['description']
             },
+            'indices': AQIIndexEngine.describe(indices, 0),
             'pollutants': pollutants,
             'forecast': forecast,
             'timestamp': current_data['dt']
@@ -0,0 +1,312 @@
+# Spatial Index for Cached Locations
+# Geohash buckets over the coordinates of every cached city (Redis or in-process)
+
+from django.conf import settings
+import math
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE_LAT = 111.2
+
+
+def encode_geohash(lat, lon, precision):
+    # Standard geohash: interleave longitude/latitude bisection bits, 5 bits per character
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bit_count = 0
+    value = 0
+    even = True
+
+    while len(chars) < precision:
+        if even:
+            mid = (lon_range[0] + lon_range[1]) / 2
+            if lon >= mid:
+                value = (value << 1) | 1
+                lon_range[0] = mid
+            else:
+                value = value << 1
+                lon_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if lat >= mid:
+                value = (value << 1) | 1
+                lat_range[0] = mid
+            else:
+                value = value << 1
+                lat_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_BASE32[value])
+            bit_count = 0
+            value = 0
+
+    return ''.join(chars)
+
+
+def geohash_cell_size(precision):
+    # (lat_degrees, lon_degrees) covered by one cell at this precision
+    bits = precision * 5
+    lon_bits = (bits + 1) // 2
+    lat_bits = bits // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    # Great-circle distance between two points
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _in_lon_range(lon, min_lon, max_lon):
+    # Longitude range test that handles boxes crossing the antimeridian
+    if min_lon <= max_lon:
+        return min_lon <= lon <= max_lon
+    return lon >= min_lon or lon <= max_lon
+
+
+class SpatialIndex:
+    # Every member is stored in one bucket per precision, so a query can pick
+    # the finest precision that still covers its area with few buckets.
+    # Members expire with their cache entries: expired ones are swept at most
+    # once per PRUNE_INTERVAL, so the index only holds cities still in the cache
+    PRECISIONS = (1, 2, 3, 4)
+    MAX_QUERY_CELLS = 64
+    INITIAL_RADIUS_KM = 50
+    PRUNE_INTERVAL = 60  # seconds
+
+    REDIS_BUCKET_PREFIX = 'aqi:geo:'
+    REDIS_LOCATIONS_KEY = 'aqi:geo:locations'
+    REDIS_EXPIRY_KEY = 'aqi:geo:expiry'  # sorted set: member -> expiry timestamp
+    REDIS_PRUNE_LOCK_KEY = 'aqi:geo:prune_lock'
+
+    # In-process store used when Redis is not available
+    _buckets = {}
+    _locations = {}
+    _expiry = {}
+    _next_prune = 0
+    _lock = threading.Lock()
+    _redis = None
+
+    @classmethod
+    def _get_redis(cls):
+        if cls._redis is None:
+            from django_redis import get_redis_connection
+            cls._redis = get_redis_connection('default')
+        return cls._redis
+
+    @classmethod
+    def _hashes_for(cls, lat, lon):
+        return [encode_geohash(lat, lon, precision) for precision in cls.PRECISIONS]
+
+    @classmethod
+    def add(cls, member, lat, lon, ttl):
+        # Insert or move a member kept for ttl seconds; called on every CacheManager.set
+        lat, lon = float(lat), float(lon)
+        new_hashes = cls._hashes_for(lat, lon)
+        expires_at = time.time() + ttl
+
+        if settings.REDIS_AVAILABLE:
+            try:
+                client = cls._get_redis()
+                previous = client.hget(cls.REDIS_LOCATIONS_KEY, member)
+                pipe = client.pipeline()
+                if previous is not None:
+                    old_lat, old_lon = map(float, previous.decode().split(','))
+                    for geohash in cls._hashes_for(old_lat, old_lon):
+                        pipe.srem(f"{cls.REDIS_BUCKET_PREFIX}{geohash}", member)
+                for geohash in new_hashes:
+                    pipe.sadd(f"{cls.REDIS_BUCKET_PREFIX}{geohash}", member)
+                pipe.hset(cls.REDIS_LOCATIONS_KEY, member, f"{lat},{lon}")
+                pipe.zadd(cls.REDIS_EXPIRY_KEY, {member: expires_at})
+                pipe.execute()
+            except Exception as e:
+                logger.error(f"Spatial index update error: {str(e)}")
+        else:
+            with cls._lock:
+                previous = cls._locations.get(member)
+                if previous is not None:
+                    for geohash in cls._hashes_for(*previous):
+                        cls._buckets.get(geohash, set()).discard(member)
+                for geohash in new_hashes:
+                    cls._buckets.setdefault(geohash, set()).add(member)
+                cls._locations[member] = (lat, lon)
+                cls._expiry[member] = expires_at
+
+        cls.prune_expired()
+
+    @classmethod
+    def prune_expired(cls, force=False):
+        # Drop members whose cache entries have expired; throttled to one sweep per
+        # PRUNE_INTERVAL across all workers unless forced
+        now = time.time()
+
+        if settings.REDIS_AVAILABLE:
+            try:
+                client = cls._get_redis()
+                if not force and not client.set(cls.REDIS_PRUNE_LOCK_KEY, 1, nx=True, ex=cls.PRUNE_INTERVAL):
+                    return
+                expired = [member.decode() for member in client.zrangebyscore(cls.REDIS_EXPIRY_KEY, '-inf', now)]
+            except Exception as e:
+                logger.error(f"Spatial index prune error: {str(e)}")
+                return
+        else:
+            with cls._lock:
+                if not force and now < cls._next_prune:
+                    return
+                cls._next_prune = now + cls.PRUNE_INTERVAL
+                expired = [member for member, expires_at in cls._expiry.items() if expires_at <= now]
+
+        if expired:
+            cls.remove(expired)
+            logger.info(f"Pruned {len(expired)} expired locations from the spatial index")
+
+    @classmethod
+    def remove(cls, members):
+        # Drop members whose cache entries no longer exist
+        if not members:
+            return
+
+        if settings.REDIS_AVAILABLE:
+            try:
+                client = cls._get_redis()
+                previous = client.hmget(cls.REDIS_LOCATIONS_KEY, members)
+                pipe = client.pipeline()
+                for member, location in zip(members, previous):
+                    if location is None:
+                        continue
+                    lat, lon = map(float, location.decode().split(','))
+                    for geohash in cls._hashes_for(lat, lon):
+                        pipe.srem(f"{cls.REDIS_BUCKET_PREFIX}{geohash}", member)
+                pipe.hdel(cls.REDIS_LOCATIONS_KEY, *members)
+                pipe.zrem(cls.REDIS_EXPIRY_KEY, *members)
+                pipe.execute()
+            except Exception as e:
+                logger.error(f"Spatial index removal error: {str(e)}")
+            return
+
+        with cls._lock:
+            for member in members:
+                cls._expiry.pop(member, None)
+                location = cls._locations.pop(member, None)
+                if location is None:
+                    continue
+                for geohash in cls._hashes_for(*location):
+                    cls._buckets.get(geohash, set()).discard(member)
+
+    @classmethod
+    def _bucket_members(cls, geohashes):
+        # Map member -> (lat, lon) for every member of the given buckets
+        if settings.REDIS_AVAILABLE:
+            client = cls._get_redis()
+            pipe = client.pipeline()
+            for geohash in geohashes:
+                pipe.smembers(f"{cls.REDIS_BUCKET_PREFIX}{geohash}")
+            members = sorted({m.decode() for bucket in pipe.execute() for m in bucket})
+            if not members:
+                return {}
+            locations = client.hmget(cls.REDIS_LOCATIONS_KEY, members)
+            return {
+                member: tuple(map(float, location.decode().split(',')))
+                for member, location in zip(members, locations)
+                if location is not None
+            }
+
+        with cls._lock:
+            return {
+                member: cls._locations[member]
+                for geohash in geohashes
+                for member in cls._buckets.get(geohash, ())
+                if member in cls._locations
+            }
+
+    @staticmethod
+    def _cell_indices(low, high, size, offset, count):
+        first = max(0, int(math.floor((low + offset) / size)))
+        last = min(count - 1, int(math.floor((high + offset) / size)))
+        return range(first, last + 1)
+
+    @classmethod
+    def _covering_cells(cls, min_lat, min_lon, max_lat, max_lon):
+        # Geohashes of the finest precision covering the box with at most MAX_QUERY_CELLS buckets
+        if min_lon <= max_lon:
+            lon_ranges = [(min_lon, max_lon)]
+        else:
+            lon_ranges = [(min_lon, 180.0), (-180.0, max_lon)]
+
+        chosen = None
+        for precision in cls.PRECISIONS:
+            lat_size, lon_size = geohash_cell_size(precision)
+            lat_cells = cls._cell_indices(min_lat, max_lat, lat_size, 90.0, round(180.0 / lat_size))
+            lon_cells = [
+                index
+                for low, high in lon_ranges
+                for index in cls._cell_indices(low, high, lon_size, 180.0, round(360.0 / lon_size))
+            ]
+            if chosen is not None and len(lat_cells) * len(lon_cells) > cls.MAX_QUERY_CELLS:
+                break
+            chosen = (precision, lat_size, lon_size, lat_cells, lon_cells)
+
+        precision, lat_size, lon_size, lat_cells, lon_cells = chosen
+        return {
+            encode_geohash(
+                (lat_index + 0.5) * lat_size - 90.0,
+                (lon_index + 0.5) * lon_size - 180.0,
+                precision
+            )
+            for lat_index in lat_cells
+            for lon_index in lon_cells
+        }
+
+    @classmethod
+    def within_bbox(cls, min_lat, min_lon, max_lat, max_lon):
+        # Members inside the box as [(member, lat, lon)]; min_lon > max_lon crosses the antimeridian
+        cells = cls._covering_cells(min_lat, min_lon, max_lat, max_lon)
+        candidates = cls._bucket_members(cells)
+        return [
+            (member, lat, lon)
+            for member, (lat, lon) in candidates.items()
+            if min_lat <= lat <= max_lat and _in_lon_range(lon, min_lon, max_lon)
+        ]
+
+    @classmethod
+    def nearest(cls, lat, lon, k):
+        # K nearest members as [(member, lat, lon, distance_km)], searching outward in growing boxes
+        radius = cls.INITIAL_RADIUS_KM
+        max_radius = math.pi * EARTH_RADIUS_KM
+
+        while True:
+            d_lat = radius / KM_PER_DEGREE_LAT
+            cos_lat = math.cos(math.radians(lat))
+            min_lat, max_lat = max(-90.0, lat - d_lat), min(90.0, lat + d_lat)
+
+            if min_lat <= -90.0 or max_lat >= 90.0 or cos_lat < 1e-6 or radius / (KM_PER_DEGREE_LAT * cos_lat) >= 180.0:
+                min_lon, max_lon = -180.0, 180.0
+            else:
+                d_lon = radius / (KM_PER_DEGREE_LAT * cos_lat)
+                min_lon = ((lon - d_lon + 180.0) % 360.0) - 180.0
+                max_lon = ((lon + d_lon + 180.0) % 360.0) - 180.0
+
+            matches = sorted(
+                (
+                    (member, m_lat, m_lon, haversine_km(lat, lon, m_lat, m_lon))
+                    for member, m_lat, m_lon in cls.within_bbox(min_lat, min_lon, max_lat, max_lon)
+                ),
+                key=lambda match: match[3]
+            )
+
+            # Only matches inside the search circle are guaranteed to be the closest ones
+            within_radius = [match for match in matches if match[3] <= radius]
+            if len(within_radius) >= k or radius >= max_radius:
+                return (within_radius if radius < max_radius else matches)[:k]
+
+            radius *= 2
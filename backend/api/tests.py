@@ -1,3 +1,938 @@
-from django.test import TestCase
+from django.test import SimpleTestCase, override_settings
+from django.core.cache import cache
+from asgiref.sync import async_to_sync
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import urlparse
+import asyncio
+import csv
+import json
+import queue
+import random
+import threading
+import time
+import warnings
 
-# Create your tests here.
+from .services import OpenWeatherService, Deadline
+from .aqi_index import AQIIndexEngine
+from .cache_manager import CacheManager
+from .broker import UpdateBroker
+from .spatial import SpatialIndex
+from .refresh_queue import RefreshQueue
+from .views import AQIStreamView, CacheExportView
+from config.asgi import application as asgi_application
+
+
+FAKE_COMPONENTS = {'co': 200.0, 'no': 0.5, 'no2': 10.0, 'o3': 60.0, 'so2': 4.0, 'pm2_5': 12.0, 'pm10': 20.0, 'nh3': 1.0}
+
+FAKE_RESPONSES = {
+    '/geo/1.0/direct': [{'lat': 18.52, 'lon': 73.86, 'name': 'Pune', 'country': 'IN'}],
+    '/data/2.5/air_pollution': {'list': [{'dt': 1700000000, 'main': {'aqi': 2}, 'components': FAKE_COMPONENTS}]},
+    '/data/2.5/air_pollution/forecast': {'list': [{'dt': 1700003600, 'main': {'aqi': 2}, 'components': FAKE_COMPONENTS}]},
+}
+
+
+# Every cache-backed test runs on the local memory fallback, with or without Redis
+LOCMEM_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'aqi-tests',
+        'TIMEOUT': 1800,
+        'OPTIONS': {'MAX_ENTRIES': 1000},
+    }
+}
+
+
+def city_payload(city, country='IN', lat=18.52, lon=73.86, aqi=2):
+    return {
+        'city': city,
+        'country': country,
+        'coordinates': {'lat': lat, 'lon': lon},
+        'aqi': {'value': aqi, 'level': 'Fair', 'description': 'Air quality is acceptable for most people'},
+        'pollutants': {'pm2_5': {'value': 12.0, 'unit': 'µg/m³'}},
+        'timestamp': 1700000000,
+    }
+
+
+def asgi_scope(path, query_string=''):
+    # Minimal HTTP scope for calling the ASGI application directly
+    return {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode('utf-8'),
+        'query_string': query_string.encode('utf-8'),
+        'root_path': '',
+        'headers': [(b'host', b'testserver')],
+        'client': ('127.0.0.1', 50000),
+        'server': ('testserver', 80),
+    }
+
+
+class FakePubSub:
+    # In-memory stand-in for a redis.asyncio pub/sub connection
+
+    def __init__(self):
+        self.channels = set()
+        self.subscribe_calls = 0
+        self.messages = asyncio.Queue()
+
+    async def subscribe(self, *channels):
+        self.subscribe_calls += 1
+        self.channels.update(channels)
+
+    async def unsubscribe(self, *channels):
+        self.channels.difference_update(channels)
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        try:
+            return await asyncio.wait_for(self.messages.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+@override_settings(CACHES=LOCMEM_CACHES, REDIS_AVAILABLE=False)
+class CacheTestCase(SimpleTestCase):
+    # Empty cache, spatial index and per-process cache state for every test
+
+    def setUp(self):
+        cache.clear()
+        CacheManager._countries = {}
+        CacheManager.reset_stats()
+        SpatialIndex._buckets = {}
+        SpatialIndex._locations = {}
+
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    # Serves canned OpenWeatherMap responses after a configurable per-request delay
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+            delay = server.delays.pop(0) if server.delays else server.default_delay
+        time.sleep(delay)
+
+        body = json.dumps(FAKE_RESPONSES.get(urlparse(self.path).path, {})).encode('utf-8')
+        try:
+            self.send_response(server.status_code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # Client already gave up on this request
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UpstreamRequestTests(SimpleTestCase):
+    # Adaptive timeouts, hedging and deadlines against a local slow server
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeUpstreamHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.request_count = 0
+        self.server.delays = []
+        self.server.default_delay = 0
+        self.server.status_code = 200
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.settings_override = override_settings(
+            OPENWEATHER_API_KEY='test-key',
+            OPENWEATHER_GEO_URL=f"{base_url}/geo/1.0",
+            OPENWEATHER_POLLUTION_URL=f"{base_url}/data/2.5",
+            UPSTREAM_TIMEOUT_MAX=5.0,
+            UPSTREAM_TIMEOUT_MIN=1.0,
+            UPSTREAM_TIMEOUT_MULTIPLIER=3.0,
+            UPSTREAM_HEDGING_ENABLED=True,
+            UPSTREAM_RATE_LIMIT_PER_MINUTE=60,
+            UPSTREAM_LATENCY_MIN_SAMPLES=20,
+        )
+        self.settings_override.enable()
+
+        # Upstream state is shared per process; start every test from scratch
+        OpenWeatherService._latency = {}
+        OpenWeatherService._rate_budget = None
+        OpenWeatherService.reset_hedge_stats()
+
+        self.service = OpenWeatherService()
+        self.url = f"{self.service.pollution_url}/air_pollution"
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _prime_latency(self, url, seconds, samples=20):
+        tracker = OpenWeatherService._tracker_for(url)
+        for _ in range(samples):
+            tracker.record(seconds)
+
+    def _timed_request(self):
+        started = time.monotonic()
+        data = self.service._make_request(self.url, {'lat': 1, 'lon': 2})
+        return data, time.monotonic() - started
+
+    def test_timeout_stays_at_maximum_until_enough_samples(self):
+        tracker = OpenWeatherService._tracker_for(self.url)
+        self._prime_latency(self.url, 0.1, samples=19)
+        self.assertEqual(self.service._adaptive_timeout(tracker), 5.0)
+
+        tracker.record(0.1)
+        self.assertEqual(self.service._adaptive_timeout(tracker), 1.0)
+
+    def test_adaptive_timeout_follows_observed_p99(self):
+        tracker = OpenWeatherService._tracker_for(self.url)
+        self._prime_latency(self.url, 0.5)
+        self.assertAlmostEqual(self.service._adaptive_timeout(tracker), 1.5)
+
+        self._prime_latency(self.url, 4.0, samples=5)
+        self.assertEqual(self.service._adaptive_timeout(tracker), 5.0)
+
+    @override_settings(UPSTREAM_HEDGING_ENABLED=False, UPSTREAM_TIMEOUT_MIN=0.3)
+    def test_adaptive_timeout_cuts_off_slow_call(self):
+        self._prime_latency(self.url, 0.05)
+        self.server.default_delay = 2.0
+
+        started = time.monotonic()
+        with self.assertRaisesMessage(Exception, 'timed out'):
+            self.service._make_request(self.url, {'lat': 1, 'lon': 2})
+        self.assertLess(time.monotonic() - started, 1.5)
+
+    @override_settings(UPSTREAM_TIMEOUT_MIN=0.3)
+    def test_timeout_recovers_after_upstream_slows_down(self):
+        self._prime_latency(self.url, 0.05)
+        self.server.default_delay = 0.5
+        tracker = OpenWeatherService._tracker_for(self.url)
+        self.assertAlmostEqual(self.service._adaptive_timeout(tracker), 0.3)
+
+        with self.assertRaisesMessage(Exception, 'timed out'):
+            self.service._make_request(self.url, {'lat': 1, 'lon': 2})
+
+        # The timed-out call counts as a 0.3s+ sample, so the next calls get room to finish
+        self.assertGreaterEqual(self.service._adaptive_timeout(tracker), 0.9)
+        for _ in range(2):
+            data, elapsed = self._timed_request()
+            self.assertEqual(data['list'][0]['main']['aqi'], 2)
+        self.assertGreaterEqual(self.service._adaptive_timeout(tracker), 1.5)
+
+    @override_settings(UPSTREAM_REQUEST_DEADLINE=0.2, UPSTREAM_HEDGING_ENABLED=False)
+    def test_deadline_cut_timeout_not_recorded(self):
+        self.server.default_delay = 0.5
+        tracker = OpenWeatherService._tracker_for(f"{self.service.geo_url}/direct")
+
+        with self.assertRaisesMessage(Exception, 'timed out'):
+            self.service.get_air_quality_by_city('Pune')
+
+        self.assertIsNone(tracker.percentile(99, 1))
+
+    def test_hedged_request_returns_first_response(self):
+        self._prime_latency(self.url, 0.05)
+        self.server.delays = [0.9, 0]
+
+        data, elapsed = self._timed_request()
+
+        self.assertEqual(data['list'][0]['main']['aqi'], 2)
+        self.assertLess(elapsed, 0.6)
+        self.assertEqual(self.server.request_count, 2)
+        self.assertEqual(OpenWeatherService.get_hedge_stats()['sent'], 1)
+        self.assertEqual(OpenWeatherService.get_hedge_stats()['won'], 1)
+        self.assertEqual(self.client.get('/api/v1/health').json()['upstream_hedging']['sent'], 1)
+
+    def test_no_hedge_before_enough_samples(self):
+        self.server.delays = [0.3]
+
+        data, elapsed = self._timed_request()
+
+        self.assertEqual(self.server.request_count, 1)
+        self.assertGreaterEqual(elapsed, 0.3)
+        self.assertEqual(OpenWeatherService.get_hedge_stats()['sent'], 0)
+
+    @override_settings(UPSTREAM_RATE_LIMIT_PER_MINUTE=1)
+    def test_hedge_counted_against_rate_budget(self):
+        self._prime_latency(self.url, 0.05)
+        self.server.delays = [0.4, 0]
+
+        data, elapsed = self._timed_request()
+
+        # The primary call took the only token, so no duplicate was sent
+        self.assertEqual(self.server.request_count, 1)
+        self.assertGreaterEqual(elapsed, 0.4)
+        self.assertEqual(OpenWeatherService.get_hedge_stats()['sent'], 0)
+        self.assertEqual(OpenWeatherService.get_hedge_stats()['skipped_budget'], 1)
+
+    @override_settings(UPSTREAM_REQUEST_DEADLINE=0.5)
+    def test_deadline_shared_across_calls(self):
+        self.server.default_delay = 0.3
+
+        started = time.monotonic()
+        with self.assertRaisesMessage(Exception, 'timed out'):
+            self.service.get_air_quality_by_city('Pune')
+
+        # Geocoding used 0.3s, so the pollution call only got the remaining ~0.2s
+        self.assertLess(time.monotonic() - started, 0.9)
+        self.assertEqual(self.server.request_count, 2)
+
+    def test_expired_deadline_skips_request(self):
+        service = OpenWeatherService(deadline=Deadline(0))
+
+        with self.assertRaisesMessage(Exception, 'timed out'):
+            service._make_request(self.url, {'lat': 1, 'lon': 2})
+        self.assertEqual(self.server.request_count, 0)
+
+    def test_full_lookup_within_deadline(self):
+        data = self.service.get_air_quality_by_city('Pune')
+
+        self.assertEqual(data['city'], 'Pune')
+        self.assertEqual(data['indices']['us_epa']['dominant_pollutant'], 'pm2_5')
+        self.assertEqual(self.server.request_count, 3)
+        self.assertIsNone(self.service.deadline)
+
+    def test_http_errors_are_mapped(self):
+        self.server.status_code = 401
+
+        with self.assertRaisesMessage(Exception, 'Invalid API key'):
+            self.service._make_request(self.url, {'lat': 1, 'lon': 2})
+
+
+@override_settings(STREAM_HEARTBEAT_INTERVAL=0.05, STREAM_REFRESH_INTERVAL=300)
+class StreamTests(CacheTestCase):
+    # Publish-on-change and the shared refresh interval behind /stream
+
+    def test_set_publishes_only_on_content_change(self):
+        with mock.patch.object(UpdateBroker, 'publish') as publish:
+            CacheManager.set('Pune', city_payload('Pune'))
+            CacheManager.set('Pune', city_payload('Pune'))
+            self.assertEqual(publish.call_count, 1)
+
+            CacheManager.set('Pune', city_payload('Pune', aqi=4))
+            self.assertEqual(publish.call_count, 2)
+            self.assertEqual(publish.call_args[0][0], 'city_pune')
+
+    def test_stream_pushes_changed_data_only(self):
+        async def run():
+            stream = AQIStreamView()._event_stream(['Pune'])
+            events = [await stream.__anext__(), await stream.__anext__()]
+            CacheManager.set('Pune', city_payload('Pune'))
+            events.append(await stream.__anext__())
+            CacheManager.set('Pune', city_payload('Pune'))
+            events.append(await stream.__anext__())
+            await stream.aclose()
+            return events
+
+        with mock.patch.object(RefreshQueue, 'enqueue'):
+            events = async_to_sync(run)()
+
+        self.assertTrue(events[0].startswith('retry:'))
+        self.assertEqual(events[1], ': keepalive\n\n')
+        self.assertTrue(events[2].startswith('event: aqi\n'))
+        self.assertIn('"city_key": "city_pune"', events[2])
+        self.assertEqual(events[3], ': keepalive\n\n')
+
+    def test_stream_snapshot_does_not_count_cache_stats(self):
+        CacheManager.set('Pune', city_payload('Pune'))
+
+        async def run():
+            stream = AQIStreamView()._event_stream(['Pune'])
+            events = [await stream.__anext__(), await stream.__anext__()]
+            await stream.aclose()
+            return events
+
+        with mock.patch.object(RefreshQueue, 'enqueue'):
+            events = async_to_sync(run)()
+
+        self.assertTrue(events[1].startswith('event: aqi\n'))
+        self.assertEqual(CacheManager.get_stats()['total_requests'], 0)
+
+    @override_settings(REDIS_AVAILABLE=True)
+    def test_streams_share_one_redis_subscription(self):
+        pubsub = FakePubSub()
+        client = mock.Mock()
+        client.pubsub.return_value = pubsub
+        self.addCleanup(UpdateBroker._redis_subscriptions.clear)
+
+        async def run():
+            listeners = [UpdateBroker.listen(['city_pune'], 5) for _ in range(3)]
+            listeners.append(UpdateBroker.listen(['city_delhi'], 5))
+            for listener in listeners:
+                await listener.__anext__()
+            self.assertEqual(pubsub.channels, {'aqi:updates:city_pune', 'aqi:updates:city_delhi'})
+
+            pubsub.messages.put_nowait({
+                'channel': b'aqi:updates:city_pune',
+                'data': json.dumps({'city_key': 'city_pune', 'data': {'aqi': 3}}),
+            })
+            updates = [await listener.__anext__() for listener in listeners[:3]]
+
+            for listener in listeners[:2]:
+                await listener.aclose()
+            self.assertIn('aqi:updates:city_pune', pubsub.channels)
+            await listeners[2].aclose()
+            self.assertEqual(pubsub.channels, {'aqi:updates:city_delhi'})
+            await listeners[3].aclose()
+            UpdateBroker._get_subscription().reader.cancel()
+            return updates
+
+        with mock.patch('redis.asyncio.from_url', return_value=client) as from_url:
+            updates = async_to_sync(run)()
+
+        self.assertEqual(from_url.call_count, 1)
+        self.assertEqual(pubsub.subscribe_calls, 2)
+        self.assertEqual([update['data'] for update in updates], [{'aqi': 3}] * 3)
+        self.assertEqual(UpdateBroker._local_subscribers, set())
+
+    def test_one_refresh_per_interval_across_streams(self):
+        async def run():
+            streams = [AQIStreamView()._event_stream(['Pune', 'Delhi']) for _ in range(3)]
+            for stream in streams:
+                for _ in range(3):
+                    await stream.__anext__()
+            for stream in streams:
+                await stream.aclose()
+
+        with mock.patch.object(RefreshQueue, 'enqueue') as enqueue:
+            async_to_sync(run)()
+
+        self.assertEqual(sorted(call[0][0] for call in enqueue.call_args_list), ['Delhi', 'Pune'])
+
+    @override_settings(STREAM_MAX_LIFETIME=0)
+    def test_stream_ends_after_max_lifetime(self):
+        async def run():
+            return [event async for event in AQIStreamView()._event_stream(['Pune'])]
+
+        events = async_to_sync(run)()
+
+        self.assertEqual(len(events), 1)
+        self.assertTrue(events[0].startswith('retry:'))
+        self.assertEqual(UpdateBroker._local_subscribers, set())
+
+    def test_client_disconnect_closes_stream(self):
+        scope = asgi_scope('/api/v1/stream', 'cities=Pune')
+
+        async def run():
+            disconnected = asyncio.Event()
+            body_sent = []
+            messages = []
+
+            async def receive():
+                if not body_sent:
+                    body_sent.append(True)
+                    return {'type': 'http.request', 'body': b'', 'more_body': False}
+                await disconnected.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                messages.append(message)
+                if b'keepalive' in message.get('body', b''):
+                    self.assertEqual(len(UpdateBroker._local_subscribers), 1)
+                    disconnected.set()
+
+            await asyncio.wait_for(asgi_application(scope, receive, send), timeout=5)
+            return messages
+
+        with mock.patch.object(RefreshQueue, 'enqueue'):
+            messages = async_to_sync(run)()
+
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertEqual(UpdateBroker._local_subscribers, set())
+
+    def test_stream_rejected_under_wsgi(self):
+        response = self.client.get('/api/v1/stream', {'cities': 'Pune'})
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['code'], 'ASGI_REQUIRED')
+
+
+class ExportTests(CacheTestCase):
+    # NDJSON/CSV rows built from CacheManager.iter_entries
+
+    def setUp(self):
+        super().setUp()
+        for city in ('Pune', 'Delhi', 'Mumbai'):
+            CacheManager.set(city, city_payload(city))
+
+    def test_iter_entries_yields_every_cached_city(self):
+        entries = dict(CacheManager.iter_entries(batch_size=2))
+
+        self.assertEqual(sorted(entries), ['city_delhi', 'city_mumbai', 'city_pune'])
+        self.assertEqual(entries['city_pune']['city'], 'Pune')
+
+    def test_iter_entries_skips_invalidated_entries(self):
+        CacheManager.invalidate_prefix('Pu')
+
+        self.assertEqual(sorted(key for key, _ in CacheManager.iter_entries()), ['city_delhi', 'city_mumbai'])
+
+    @mock.patch.object(CacheExportView, 'BATCH_SIZE', 2)
+    def test_csv_export_under_wsgi(self):
+        response = self.client.get('/api/v1/export', {'format': 'csv'})
+
+        self.assertTrue(response.streaming)
+        rows = list(csv.reader(b''.join(response.streaming_content).decode('utf-8').splitlines()))
+        self.assertEqual(rows[0], CacheExportView.CSV_HEADER)
+        self.assertEqual(sorted(row[0] for row in rows[1:]), ['Delhi', 'Mumbai', 'Pune'])
+        self.assertEqual(rows[1][CacheExportView.CSV_HEADER.index('aqi')], '2')
+
+    @mock.patch.object(CacheExportView, 'BATCH_SIZE', 2)
+    def test_ndjson_export_streams_asynchronously_under_asgi(self):
+        async def run():
+            body_sent = []
+            messages = []
+
+            async def receive():
+                if not body_sent:
+                    body_sent.append(True)
+                    return {'type': 'http.request', 'body': b'', 'more_body': False}
+                await asyncio.Event().wait()
+
+            async def send(message):
+                messages.append(message)
+
+            await asyncio.wait_for(
+                asgi_application(asgi_scope('/api/v1/export', 'format=ndjson'), receive, send),
+                timeout=5
+            )
+            return messages
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            messages = async_to_sync(run)()
+
+        # Django warns when it has to buffer a synchronous iterator under ASGI
+        self.assertFalse([w for w in caught if 'synchronous iterators' in str(w.message)])
+        self.assertEqual(messages[0]['status'], 200)
+        body = b''.join(message.get('body', b'') for message in messages[1:])
+        lines = [json.loads(line) for line in body.decode('utf-8').splitlines()]
+        self.assertEqual(sorted(line['city'] for line in lines), ['Delhi', 'Mumbai', 'Pune'])
+
+
+class SpatialIndexTests(CacheTestCase):
+    # nearest/within_bbox over geohash buckets, including boxes across the antimeridian
+
+    LOCATIONS = {
+        'city_pune': (18.52, 73.86),
+        'city_mumbai': (19.08, 72.88),
+        'city_delhi': (28.61, 77.21),
+        'city_suva': (-18.14, 178.44),
+        'city_apia': (-13.83, -171.77),
+        'city_london': (51.51, -0.13),
+    }
+
+    def setUp(self):
+        super().setUp()
+        for member, (lat, lon) in self.LOCATIONS.items():
+            SpatialIndex.add(member, lat, lon, 3600)
+
+    def test_within_bbox(self):
+        members = {match[0] for match in SpatialIndex.within_bbox(15, 70, 30, 80)}
+
+        self.assertEqual(members, {'city_pune', 'city_mumbai', 'city_delhi'})
+
+    def test_within_bbox_across_antimeridian(self):
+        members = {match[0] for match in SpatialIndex.within_bbox(-25, 170, -10, -165)}
+
+        self.assertEqual(members, {'city_suva', 'city_apia'})
+
+    def test_nearest_orders_by_distance(self):
+        matches = SpatialIndex.nearest(18.6, 73.9, 2)
+
+        self.assertEqual([match[0] for match in matches], ['city_pune', 'city_mumbai'])
+        self.assertLess(matches[0][3], matches[1][3])
+
+    def test_nearest_across_antimeridian(self):
+        matches = SpatialIndex.nearest(-16, 179.9, 2)
+
+        self.assertEqual([match[0] for match in matches], ['city_suva', 'city_apia'])
+        self.assertLess(matches[1][3], 1500)
+
+    def test_moved_member_leaves_old_buckets(self):
+        SpatialIndex.add('city_pune', 51.5, -0.1, 3600)
+
+        self.assertNotIn('city_pune', {match[0] for match in SpatialIndex.within_bbox(15, 70, 30, 80)})
+
+    def test_expired_members_are_pruned(self):
+        SpatialIndex.add('city_delhi', 28.61, 77.21, -1)
+        SpatialIndex.prune_expired(force=True)
+
+        self.assertNotIn('city_delhi', SpatialIndex._locations)
+        self.assertNotIn('city_delhi', SpatialIndex._expiry)
+        self.assertEqual({match[0] for match in SpatialIndex.within_bbox(15, 70, 30, 80)}, {'city_pune', 'city_mumbai'})
+
+
+class BoundingBoxViewTests(CacheTestCase):
+    # /bbox ordering, pruning and truncation
+
+    def setUp(self):
+        super().setUp()
+        CacheManager.set('Pune', city_payload('Pune', lat=18.52, lon=73.86))
+        CacheManager.set('Mumbai', city_payload('Mumbai', lat=19.08, lon=72.88))
+        CacheManager.set('Delhi', city_payload('Delhi', lat=28.61, lon=77.21))
+        CacheManager.set('Ahmedabad', city_payload('Ahmedabad', lat=23.02, lon=72.57))
+
+    def _bbox(self, limit, **bounds):
+        params = {'min_lat': 15, 'min_lon': 70, 'max_lat': 30, 'max_lon': 80, 'limit': limit}
+        params.update(bounds)
+        return self.client.get('/api/v1/bbox', params).json()
+
+    def test_sorted_by_distance_from_centre(self):
+        response = self._bbox(2, min_lat=18, max_lat=20, min_lon=72, max_lon=74)
+
+        self.assertEqual([row['city'] for row in response['data']], ['Mumbai', 'Pune'])
+        self.assertFalse(response['truncated'])
+
+    def test_expired_entries_pruned_before_truncating(self):
+        # Nearest to the centre (22.5, 75): Ahmedabad, Mumbai, Pune, Delhi; drop Ahmedabad from the cache
+        CacheManager.delete('Ahmedabad')
+
+        response = self._bbox(2)
+
+        self.assertEqual(response['count'], 2)
+        self.assertEqual([row['city'] for row in response['data']], ['Mumbai', 'Pune'])
+        self.assertTrue(response['truncated'])
+        self.assertNotIn('city_ahmedabad', SpatialIndex._locations)
+
+    def test_not_truncated_when_only_expired_entries_remain(self):
+        CacheManager.delete('Delhi')
+
+        response = self._bbox(3)
+
+        self.assertEqual(response['count'], 3)
+        self.assertFalse(response['truncated'])
+
+
+    def test_cache_read_failure_keeps_index(self):
+        with mock.patch.object(cache, 'get_many', side_effect=ConnectionError('cache down')):
+            response = self.client.get('/api/v1/bbox', {'min_lat': 15, 'min_lon': 70, 'max_lat': 30, 'max_lon': 80})
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json()['code'], 'SERVER_ERROR')
+        self.assertEqual(len(SpatialIndex._locations), 4)
+        self.assertEqual(self._bbox(10)['count'], 4)
+
+    def test_stale_entries_stay_indexed(self):
+        # Past its freshness window but still kept for stale serving
+        CacheManager.set('Delhi', city_payload('Delhi', lat=28.61, lon=77.21), timeout=-1)
+
+        response = self._bbox(10)
+
+        self.assertEqual(response['count'], 3)
+        self.assertIn('city_delhi', SpatialIndex._locations)
+
+class AQIIndexEngineTests(SimpleTestCase):
+    # Known US EPA / EU CAQI breakpoints and agreement with the per-row reference
+
+    def _describe(self, components):
+        return AQIIndexEngine.describe(AQIIndexEngine.compute([components]), 0)
+
+    def test_us_epa_breakpoints(self):
+        cases = [
+            ({'pm2_5': 9.0}, 50),
+            ({'pm2_5': 9.1}, 51),
+            ({'pm2_5': 35.4}, 100),
+            ({'pm2_5': 55.5}, 151),
+            ({'pm2_5': 12.0}, 56),
+            ({'pm10': 154}, 100),
+            ({'pm10': 155}, 101),
+            ({'pm2_5': 400}, 500),
+        ]
+        for components, expected in cases:
+            with self.subTest(components=components):
+                self.assertEqual(self._describe(components)['us_epa']['value'], expected)
+
+    def test_eu_caqi_breakpoints(self):
+        cases = [
+            ({'pm2_5': 15}, 25),
+            ({'pm2_5': 30}, 50),
+            ({'pm10': 50}, 50),
+            ({'no2': 400}, 100),
+            ({'pm2_5': 165}, 125),
+        ]
+        for components, expected in cases:
+            with self.subTest(components=components):
+                self.assertEqual(self._describe(components)['eu_caqi']['value'], expected)
+
+    def test_overall_is_worst_sub_index(self):
+        description = self._describe({'pm2_5': 12.0, 'pm10': 20, 'o3': 60})
+
+        self.assertEqual(description['us_epa']['value'], 56)
+        self.assertEqual(description['us_epa']['category'], 'Moderate')
+        self.assertEqual(description['us_epa']['dominant_pollutant'], 'pm2_5')
+        self.assertEqual(description['eu_caqi']['value'], 25)
+        self.assertEqual(description['eu_caqi']['dominant_pollutant'], 'o3')
+
+    def test_reading_without_pollutants(self):
+        description = self._describe({'nh3': 1.0})
+
+        self.assertIsNone(description['us_epa']['value'])
+        self.assertIsNone(description['us_epa']['dominant_pollutant'])
+        self.assertIsNone(description['eu_caqi']['category'])
+
+    def test_vectorized_matches_naive(self):
+        rng = random.Random(42)
+        components_list = []
+        for _ in range(500):
+            components = {
+                'pm2_5': rng.uniform(0, 400),
+                'pm10': rng.uniform(0, 700),
+                'o3': rng.uniform(0, 1000),
+                'no2': rng.uniform(0, 3000),
+                'so2': rng.uniform(0, 2000),
+                'co': rng.uniform(0, 60000),
+            }
+            # Drop some pollutants to cover missing components
+            for pollutant in rng.sample(sorted(components), rng.randint(0, 3)):
+                del components[pollutant]
+            components_list.append(components)
+
+        result = AQIIndexEngine.compute(components_list)
+        expected = AQIIndexEngine.compute_naive(components_list)
+
+        for row, reference in enumerate(expected):
+            with self.subTest(row=row):
+                self.assertEqual(AQIIndexEngine.value_at(result, 'us_epa', row), reference['us_epa'])
+                self.assertEqual(AQIIndexEngine.value_at(result, 'eu_caqi', row), reference['eu_caqi'])
+
+
+class CacheInvalidationTests(CacheTestCase):
+    # Generation-versioned invalidation hides exactly its scope
+
+    def setUp(self):
+        super().setUp()
+        CacheManager.set('Pune', city_payload('Pune', country='IN'))
+        CacheManager.set('Punta Arenas', city_payload('Punta Arenas', country='CL'))
+        CacheManager.set('Delhi', city_payload('Delhi', country='IN'))
+        CacheManager.set('London', city_payload('London', country='GB'))
+
+    def _cached(self):
+        return sorted(city for city in ('Pune', 'Punta Arenas', 'Delhi', 'London') if CacheManager.get(city))
+
+    def test_clear_all(self):
+        generation = CacheManager.current_generation()
+
+        CacheManager.clear_all()
+
+        self.assertEqual(self._cached(), [])
+        self.assertEqual(CacheManager.current_generation(), generation + 1)
+        CacheManager.set('Pune', city_payload('Pune'))
+        self.assertEqual(self._cached(), ['Pune'])
+
+    def test_invalidate_country(self):
+        CacheManager.invalidate_country('in')
+
+        self.assertEqual(self._cached(), ['London', 'Punta Arenas'])
+
+    def test_invalidate_prefix(self):
+        CacheManager.invalidate_prefix('Pun')
+
+        self.assertEqual(self._cached(), ['Delhi', 'London'])
+
+    def test_long_prefix_invalidates_through_shortest_scope(self):
+        CacheManager.invalidate_prefix('Punta')
+
+        self.assertEqual(self._cached(), ['Delhi', 'London'])
+
+    def test_recached_entry_is_valid_after_invalidation(self):
+        CacheManager.invalidate_country('IN')
+        CacheManager.set('Delhi', city_payload('Delhi', country='IN'))
+
+        self.assertEqual(self._cached(), ['Delhi', 'London', 'Punta Arenas'])
+
+    def test_evicted_counter_does_not_revive_invalidated_entries(self):
+        CacheManager.invalidate_country('IN')
+        cache.delete(f"{CacheManager.COUNTRY_GENERATION_PREFIX}in")
+
+        self.assertEqual(self._cached(), ['London', 'Punta Arenas'])
+
+    def test_scope_keys_are_bounded(self):
+        keys = CacheManager._scope_keys(CacheManager.key_for('x' * 100), 'IN')
+
+        self.assertEqual(len(keys), len(CacheManager.PREFIX_LENGTHS) + 1)
+
+
+@override_settings(REFRESH_WAIT_TIMEOUT=0.2)
+class RefreshQueueTests(CacheTestCase):
+    # Deduplicated, prioritized refresh jobs and the 202 path of /search
+
+    def setUp(self):
+        super().setUp()
+        RefreshQueue._local_queue = queue.PriorityQueue()
+        # Jobs stay queued unless a test runs a worker explicitly
+        patcher = mock.patch.object(RefreshQueue, '_ensure_local_workers')
+        self.ensure_local_workers = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _queued(self):
+        jobs = []
+        while not RefreshQueue._local_queue.empty():
+            jobs.append(RefreshQueue._pop(0))
+        return [city for city, _ in jobs]
+
+    def _run_worker(self):
+        stop_event = threading.Event()
+        worker = threading.Thread(target=RefreshQueue.work, args=(stop_event, 0.05), daemon=True)
+        worker.start()
+        self.addCleanup(worker.join)
+        self.addCleanup(stop_event.set)
+
+    def test_enqueue_deduplicates_by_normalized_city(self):
+        self.assertTrue(RefreshQueue.enqueue('New York'))
+        self.assertFalse(RefreshQueue.enqueue('new york '))
+
+        self.assertEqual(self._queued(), ['New York'])
+
+    def test_priority_promotes_queued_job_once(self):
+        RefreshQueue.enqueue('Pune')
+        RefreshQueue.enqueue('Delhi')
+        RefreshQueue.enqueue('Delhi', priority=True)
+        RefreshQueue.enqueue('Delhi', priority=True)
+
+        self.assertEqual(self._queued(), ['Delhi', 'Pune', 'Delhi'])
+
+    def test_promoted_duplicate_fetches_once(self):
+        RefreshQueue.enqueue('Pune')
+        RefreshQueue.enqueue('Pune', priority=True)
+
+        with mock.patch.object(OpenWeatherService, 'get_air_quality_by_city', return_value=city_payload('Pune')) as fetch:
+            for city, queued_at in [RefreshQueue._pop(0), RefreshQueue._pop(0)]:
+                RefreshQueue.process(city, queued_at)
+
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(CacheManager.get('Pune')['city'], 'Pune')
+
+    def test_expired_job_is_logged(self):
+        RefreshQueue.enqueue('Pune')
+        city, _ = RefreshQueue._pop(0)
+        cache.delete(RefreshQueue._pending_key(city))
+
+        with mock.patch.object(OpenWeatherService, 'get_air_quality_by_city') as fetch:
+            with self.assertLogs('api.refresh_queue', level='WARNING') as logs:
+                RefreshQueue.process(city, time.time() - 400)
+
+        fetch.assert_not_called()
+        self.assertIn('REFRESH_JOB_TTL', logs.output[0])
+
+    def test_search_returns_202_while_refresh_pending(self):
+        response = self.client.get('/api/v1/search', {'city': 'Pune'})
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['code'], 'REFRESH_PENDING')
+        self.assertEqual(self._queued(), ['Pune'])
+
+    def test_search_waits_for_queued_fetch(self):
+        self._run_worker()
+
+        with mock.patch.object(OpenWeatherService, 'get_air_quality_by_city', return_value=city_payload('Pune')):
+            response = self.client.get('/api/v1/search', {'city': 'Pune'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.json()['from_cache'])
+
+    def test_search_reports_upstream_error(self):
+        self._run_worker()
+
+        with mock.patch.object(OpenWeatherService, 'get_air_quality_by_city', side_effect=Exception('City not found.')):
+            response = self.client.get('/api/v1/search', {'city': 'Atlantis'})
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()['code'], 'CITY_NOT_FOUND')
+
+    @override_settings(REDIS_AVAILABLE=True)
+    def test_redis_without_worker_heartbeat_fetches_in_process(self):
+        with mock.patch.object(RefreshQueue, '_redis', mock.MagicMock()):
+            RefreshQueue.enqueue('Pune')
+            self.assertEqual(self.ensure_local_workers.call_count, 1)
+
+            RefreshQueue.heartbeat()
+            RefreshQueue.enqueue('Delhi')
+            self.assertEqual(self.ensure_local_workers.call_count, 1)
+
+
+class CacheInventoryTests(CacheTestCase):
+    # Cursor paging, per-key figures and the size histogram of the inventory
+
+    CITIES = ('Pune', 'Delhi', 'Mumbai', 'Chennai', 'Kolkata')
+
+    def setUp(self):
+        super().setUp()
+        for city in self.CITIES:
+            CacheManager.set(city, city_payload(city))
+
+    def test_cursor_pages_cover_namespace_once(self):
+        keys = []
+        cursor = 0
+        pages = 0
+        while True:
+            inventory = CacheManager.inventory(cursor, count=2)
+            keys += [item['key'] for item in inventory['keys']]
+            pages += 1
+            cursor = inventory['cursor']
+            self.assertEqual(inventory['complete'], cursor == 0)
+            if inventory['complete']:
+                break
+
+        self.assertEqual(pages, 3)
+        self.assertEqual(sorted(keys), sorted(CacheManager.key_for(city) for city in self.CITIES))
+
+    def test_per_key_figures(self):
+        CacheManager.get('Pune')
+        CacheManager.get('Pune')
+
+        items = {item['key']: item for item in CacheManager.inventory(0, 100)['keys']}
+
+        pune = items['city_pune']
+        self.assertEqual(pune['city'], 'Pune')
+        self.assertEqual(pune['hits'], 2)
+        self.assertEqual(items['city_delhi']['hits'], 0)
+        self.assertGreater(pune['size_bytes'], 0)
+        self.assertGreater(pune['ttl_seconds'], pune['fresh_for_seconds'])
+
+    def test_size_histogram_and_page_totals(self):
+        large = city_payload('Jaipur')
+        large['forecast'] = [{'dt': 1700000000 + hour * 3600, 'aqi': 2, 'note': f'{hour:064d}'} for hour in range(96)]
+        CacheManager.set('Jaipur', large)
+
+        inventory = CacheManager.inventory(0, 100)
+
+        totals = inventory['page_totals']
+        self.assertEqual(totals['keys'], 6)
+        self.assertEqual(totals['size_bytes'], sum(item['size_bytes'] for item in inventory['keys']))
+        self.assertEqual(sum(totals['size_histogram'].values()), 6)
+        self.assertEqual(totals['size_histogram']['<1KB'], 5)
+        self.assertEqual(totals['size_histogram']['4-16KB'], 1)
+        self.assertEqual(inventory['backend']['backend'], 'locmem')
+
+    def test_invalidated_generation_is_not_listed(self):
+        CacheManager.clear_all()
+
+        inventory = CacheManager.inventory(0, 100)
+
+        self.assertEqual(inventory['keys'], [])
+        self.assertTrue(inventory['complete'])
+
+    def test_scope_invalidated_keys_are_flagged(self):
+        CacheManager.set('Paris', city_payload('Paris', country='FR'))
+        CacheManager.invalidate_country('FR')
+        CacheManager.invalidate_prefix('Pu')
+
+        inventory = CacheManager.inventory(0, 100)
+
+        items = {item['key']: item for item in inventory['keys']}
+        self.assertTrue(items['city_paris']['invalidated'])
+        self.assertTrue(items['city_pune']['invalidated'])
+        self.assertIsNone(items['city_pune']['fresh_for_seconds'])
+        self.assertFalse(items['city_delhi']['invalidated'])
+        self.assertGreater(items['city_delhi']['fresh_for_seconds'], 0)
+        self.assertEqual(inventory['page_totals']['invalidated_keys'], 2)
+        self.assertEqual(inventory['page_totals']['stale_keys'], 0)
+
+    def test_inventory_requires_admin(self):
+        response = self.client.get('/api/v1/cache/inventory')
+
+        self.assertEqual(response.status_code, 403)
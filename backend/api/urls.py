@@ -3,10 +3,26 @@ API URL Configuration
 """
 
 from django.urls import path
-from .views import SearchCityAPIView, CacheStatsAPIView, HealthCheckAPIView
+from .views import (
+    SearchCityAPIView,
+    AQIStreamView,
+    CacheExportView,
+    NearbyCitiesAPIView,
+    BoundingBoxAPIView,
+    CacheStatsAPIView,
+    CacheInventoryAPIView,
+    CacheInvalidateAPIView,
+    HealthCheckAPIView
+)
 
 urlpatterns = [
     path('search', SearchCityAPIView.as_view(), name='search-city'),
+    path('stream', AQIStreamView.as_view(), name='aqi-stream'),
+    path('export', CacheExportView.as_view(), name='cache-export'),
+    path('nearby', NearbyCitiesAPIView.as_view(), name='nearby-cities'),
+    path('bbox', BoundingBoxAPIView.as_view(), name='bbox-cities'),
     path('cache/stats', CacheStatsAPIView.as_view(), name='cache-stats'),
+    path('cache/inventory', CacheInventoryAPIView.as_view(), name='cache-inventory'),
+    path('cache/invalidate', CacheInvalidateAPIView.as_view(), name='cache-invalidate'),
     path('health', HealthCheckAPIView.as_view(), name='health-check'),
 ]
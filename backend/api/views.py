@@ -3,17 +3,34 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.permissions import IsAdminUser
 from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.views import View
+from asgiref.sync import sync_to_async
+import csv
+import json
 import time
 import logging
 
-from .services import OpenWeatherService
 from .cache_manager import CacheManager
+from .services import OpenWeatherService
+from .refresh_queue import RefreshQueue
+from .broker import UpdateBroker
+from .spatial import SpatialIndex, haversine_km
 from .serializers import (
     CitySearchSerializer,
+    CityStreamSerializer,
+    CacheExportSerializer,
+    NearbySearchSerializer,
+    BoundingBoxSerializer,
+    LocationSummarySerializer,
     AirQualityDataSerializer,
     ErrorSerializer,
-    CacheStatsSerializer
+    CacheStatsSerializer,
+    CacheInvalidateSerializer,
+    CacheInventorySerializer
 )
 
 logger = logging.getLogger(__name__)
@@ -58,12 +75,35 @@ class SearchCityAPIView(APIView):
                     'from_cache': True
                 }, status=status.HTTP_200_OK)
             
-            # Cache miss - fetch from API
-            weather_service = OpenWeatherService()
-            air_quality_data = weather_service.get_air_quality_by_city(city_name)
+            # Expired data still in cache - serve it and refresh in the background
+            stale_data = CacheManager.get_stale(city_name)
+            if stale_data:
+                RefreshQueue.enqueue(city_name)
+                stale_data['cached'] = True
+                stale_data['stale'] = True
+                response_time = round((time.time() - start_time) * 1000, 2)  # ms
+                
+                logger.info(f"Returned stale data for '{city_name}' in {response_time}ms")
+                
+                return Response({
+                    'status': 'success',
+                    'data': stale_data,
+                    'response_time_ms': response_time,
+                    'from_cache': True
+                }, status=status.HTTP_200_OK)
+            
+            # Cache miss - queue a priority fetch and wait briefly for it
+            RefreshQueue.enqueue(city_name, priority=True)
+            air_quality_data = RefreshQueue.wait(city_name, settings.REFRESH_WAIT_TIMEOUT)
             
-            # Store in cache
-            CacheManager.set(city_name, air_quality_data)
+            if air_quality_data is None:
+                logger.info(f"Refresh still pending for '{city_name}'")
+                return Response({
+                    'status': 'pending',
+                    'message': 'Air quality data is being fetched. Please retry shortly.',
+                    'code': 'REFRESH_PENDING',
+                    'retry_after': 1
+                }, status=status.HTTP_202_ACCEPTED)
             
             # Add cache indicator
             air_quality_data['cached'] = False
@@ -106,6 +146,330 @@ class SearchCityAPIView(APIView):
             return Response(error_data, status=status_code)
 
 
+class AQIStreamView(View):
+    # Server-Sent Events endpoint pushing city updates as the cache changes
+    # GET /api/v1/stream?cities=<city_name>,<city_name>
+    # Async view - serve through the ASGI application (config.asgi)
+    
+    async def get(self, request):
+        # Handle GET request for a city subscription stream
+        
+        # Under WSGI the endless stream would be buffered and hold a server thread forever
+        if not isinstance(request, ASGIRequest):
+            return JsonResponse({
+                'status': 'error',
+                'message': 'Streaming requires the ASGI server (uvicorn config.asgi:application)',
+                'code': 'ASGI_REQUIRED'
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        
+        stream_serializer = CityStreamSerializer(data=request.GET)
+        if not stream_serializer.is_valid():
+            error_data = {
+                'status': 'error',
+                'message': 'Invalid request parameters',
+                'errors': stream_serializer.errors
+            }
+            return JsonResponse(error_data, status=status.HTTP_400_BAD_REQUEST)
+        
+        cities = stream_serializer.validated_data['cities']
+        
+        response = StreamingHttpResponse(
+            self._event_stream(cities),
+            content_type='text/event-stream'
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+    
+    @staticmethod
+    def _format_event(city_key, data):
+        # Serialize an update as an SSE message
+        payload = json.dumps({'city_key': city_key, 'data': data}, default=str)
+        return f"event: aqi\ndata: {payload}\n\n"
+    
+    async def _refresh_due_cities(self, cities):
+        # The refresh lock makes each city fetched once per interval, no matter how
+        # many streams or workers are subscribed to it; CacheManager.set then
+        # publishes the result only if it changed
+        for city_name in cities:
+            acquired = await sync_to_async(CacheManager.acquire_refresh_lock)(
+                city_name, settings.STREAM_REFRESH_INTERVAL
+            )
+            if acquired:
+                await sync_to_async(RefreshQueue.enqueue)(city_name)
+    
+    async def _event_stream(self, cities):
+        # Initial snapshot from cache, then pushes from the update broker.
+        # The stream ends after STREAM_MAX_LIFETIME so clients reconnect and
+        # abandoned subscriptions cannot outlive it
+        city_keys = [CacheManager.key_for(city_name) for city_name in cities]
+        
+        yield f"retry: {settings.STREAM_HEARTBEAT_INTERVAL * 1000}\n\n"
+        
+        for city_name, city_key in zip(cities, city_keys):
+            cached_data = await sync_to_async(CacheManager.get)(city_name, record_stats=False)
+            if cached_data:
+                yield self._format_event(city_key, cached_data)
+        
+        listener = UpdateBroker.listen(city_keys, settings.STREAM_HEARTBEAT_INTERVAL)
+        next_refresh = 0
+        stream_ends = time.monotonic() + settings.STREAM_MAX_LIFETIME
+        try:
+            async for update in listener:
+                if time.monotonic() >= stream_ends:
+                    break
+                
+                if update is None:
+                    yield ": keepalive\n\n"
+                else:
+                    yield self._format_event(update['city_key'], update['data'])
+                
+                if time.monotonic() >= next_refresh:
+                    next_refresh = time.monotonic() + settings.STREAM_HEARTBEAT_INTERVAL
+                    await self._refresh_due_cities(cities)
+        finally:
+            await listener.aclose()
+
+
+class _EchoBuffer:
+    # File-like object for csv.writer that hands each row back instead of storing it
+    
+    def write(self, value):
+        return value
+
+
+class CacheExportView(View):
+    # Streaming export of every cached city payload
+    # GET /api/v1/export?format=ndjson|csv
+    
+    CSV_POLLUTANTS = ['co', 'no', 'no2', 'o3', 'so2', 'pm2_5', 'pm10', 'nh3']
+    CSV_HEADER = (
+        ['city', 'country', 'lat', 'lon', 'aqi', 'aqi_level']
+        + CSV_POLLUTANTS
+        + ['timestamp', 'cached_at']
+    )
+    BATCH_SIZE = 100
+    
+    def get(self, request):
+        # Handle GET request for a cache export
+        
+        export_serializer = CacheExportSerializer(data=request.GET)
+        if not export_serializer.is_valid():
+            error_data = {
+                'status': 'error',
+                'message': 'Invalid request parameters',
+                'errors': export_serializer.errors
+            }
+            return JsonResponse(error_data, status=status.HTTP_400_BAD_REQUEST)
+        
+        export_format = export_serializer.validated_data['format']
+        
+        if export_format == 'csv':
+            header, render, content_type = self._csv_header(), self._csv_rows, 'text/csv'
+        else:
+            header, render, content_type = '', self._ndjson_lines, 'application/x-ndjson'
+        
+        # Django buffers whole sync iterators under ASGI (and async ones under WSGI),
+        # so pick the iterator type matching the server to keep memory constant
+        if isinstance(request, ASGIRequest):
+            content = self._stream_async(header, render)
+        else:
+            content = self._stream(header, render)
+        
+        response = StreamingHttpResponse(content, content_type=content_type)
+        filename = f"aqi_export_{int(time.time())}.{export_format}"
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+    
+    def _batches(self):
+        # Lists of cached payloads, one cache round trip per list
+        batch = []
+        for _, data in CacheManager.iter_entries(batch_size=self.BATCH_SIZE):
+            batch.append(data)
+            if len(batch) >= self.BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    
+    def _stream(self, header, render):
+        # Synchronous iterator for WSGI servers
+        if header:
+            yield header
+        for batch in self._batches():
+            yield from render(batch)
+    
+    async def _stream_async(self, header, render):
+        # Asynchronous iterator for ASGI servers; cache reads run in a worker thread
+        if header:
+            yield header
+        batches = self._batches()
+        next_batch = sync_to_async(next)
+        while True:
+            batch = await next_batch(batches, None)
+            if batch is None:
+                break
+            for chunk in render(batch):
+                yield chunk
+    
+    def _ndjson_lines(self, batch):
+        # One full cached payload (including forecast) per line
+        for data in batch:
+            yield json.dumps(data, default=str) + '\n'
+    
+    def _csv_header(self):
+        return csv.writer(_EchoBuffer()).writerow(self.CSV_HEADER)
+    
+    def _csv_rows(self, batch):
+        # One row per city with the current reading flattened
+        writer = csv.writer(_EchoBuffer())
+        
+        for data in batch:
+            coordinates = data.get('coordinates', {})
+            aqi = data.get('aqi', {})
+            pollutants = data.get('pollutants', {})
+            
+            row = [
+                data.get('city'),
+                data.get('country'),
+                coordinates.get('lat'),
+                coordinates.get('lon'),
+                aqi.get('value'),
+                aqi.get('level'),
+            ]
+            row += [pollutants.get(key, {}).get('value') for key in self.CSV_POLLUTANTS]
+            row += [data.get('timestamp'), data.get('cached_at')]
+            
+            yield writer.writerow(row)
+
+
+def _location_summaries(matches):
+    # Build cached AQI summaries for spatial index matches (member, lat, lon[, distance_km])
+    # Raises if the cache cannot be read; the index is then left untouched
+    cached, gone = CacheManager.get_by_keys(match[0] for match in matches)
+    
+    # Index entries outlive their cache entries; prune the evicted or invalidated ones lazily
+    SpatialIndex.remove(gone)
+    
+    summaries = []
+    for match in matches:
+        data = cached.get(match[0])
+        if data is None:
+            continue
+        summary = {
+            'city_key': match[0],
+            'city': data.get('city'),
+            'country': data.get('country'),
+            'coordinates': data.get('coordinates'),
+            'aqi': data.get('aqi'),
+            'timestamp': data.get('timestamp'),
+            'cached_at': data.get('cached_at'),
+        }
+        if len(match) > 3:
+            summary['distance_km'] = round(match[3], 2)
+        summaries.append(summary)
+    
+    return LocationSummarySerializer(summaries, many=True).data
+
+
+class NearbyCitiesAPIView(APIView):
+    # API endpoint for the K nearest cached cities to a point
+    # GET /api/v1/nearby?lat=<lat>&lon=<lon>&k=<count>
+    
+    def get(self, request):
+        # Handle GET request for nearest cached cities (no upstream calls)
+        
+        nearby_serializer = NearbySearchSerializer(data=request.query_params)
+        if not nearby_serializer.is_valid():
+            error_data = {
+                'status': 'error',
+                'message': 'Invalid request parameters',
+                'errors': nearby_serializer.errors
+            }
+            return Response(error_data, status=status.HTTP_400_BAD_REQUEST)
+        
+        params = nearby_serializer.validated_data
+        
+        try:
+            # Retry once if entries were pruned from the first result set
+            for _ in range(2):
+                matches = SpatialIndex.nearest(params['lat'], params['lon'], params['k'])
+                results = _location_summaries(matches)
+                if len(results) == len(matches):
+                    break
+        except Exception as e:
+            logger.error(f"Cached location lookup error: {str(e)}")
+            return Response({
+                'status': 'error',
+                'message': 'Unable to read cached locations',
+                'code': 'SERVER_ERROR'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        
+        return Response({
+            'status': 'success',
+            'count': len(results),
+            'data': results
+        }, status=status.HTTP_200_OK)
+
+
+class BoundingBoxAPIView(APIView):
+    # API endpoint for cached cities inside a map bounding box
+    # GET /api/v1/bbox?min_lat=&min_lon=&max_lat=&max_lon=&limit=
+    
+    def get(self, request):
+        # Handle GET request for cached cities in a bounding box (no upstream calls)
+        
+        bbox_serializer = BoundingBoxSerializer(data=request.query_params)
+        if not bbox_serializer.is_valid():
+            error_data = {
+                'status': 'error',
+                'message': 'Invalid request parameters',
+                'errors': bbox_serializer.errors
+            }
+            return Response(error_data, status=status.HTTP_400_BAD_REQUEST)
+        
+        params = bbox_serializer.validated_data
+        limit = params['limit']
+        
+        # Closest to the box centre first; min_lon > max_lon wraps across the antimeridian
+        centre_lat = (params['min_lat'] + params['max_lat']) / 2
+        max_lon = params['max_lon'] if params['min_lon'] <= params['max_lon'] else params['max_lon'] + 360
+        centre_lon = ((params['min_lon'] + max_lon) / 2 + 180) % 360 - 180
+        matches = sorted(
+            (
+                (member, lat, lon, haversine_km(centre_lat, centre_lon, lat, lon))
+                for member, lat, lon in SpatialIndex.within_bbox(
+                    params['min_lat'], params['min_lon'], params['max_lat'], params['max_lon']
+                )
+            ),
+            key=lambda match: match[3]
+        )
+        
+        # Expired entries are pruned before truncating; one extra live row tells
+        # whether the result was cut off
+        results = []
+        position = 0
+        try:
+            while len(results) <= limit and position < len(matches):
+                batch = matches[position:position + limit + 1 - len(results)]
+                results += _location_summaries(batch)
+                position += len(batch)
+        except Exception as e:
+            logger.error(f"Cached location lookup error: {str(e)}")
+            return Response({
+                'status': 'error',
+                'message': 'Unable to read cached locations',
+                'code': 'SERVER_ERROR'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        
+        return Response({
+            'status': 'success',
+            'count': min(len(results), limit),
+            'truncated': len(results) > limit,
+            'data': results[:limit]
+        }, status=status.HTTP_200_OK)
+
+
 class CacheStatsAPIView(APIView):
     # API endpoint for cache statistics
     # GET /api/v1/cache/stats
@@ -139,6 +503,78 @@ class CacheStatsAPIView(APIView):
         }, status=status.HTTP_200_OK)
 
 
+class CacheInventoryAPIView(APIView):
+    # API endpoint for paginated cache key inventory and memory footprint (admin only)
+    # GET /api/v1/cache/inventory?cursor=<cursor>&count=<page_size>
+    
+    permission_classes = [IsAdminUser]
+    
+    def get(self, request):
+        # Handle GET request for one inventory page; pass back `cursor` until it is 0
+        
+        inventory_serializer = CacheInventorySerializer(data=request.query_params)
+        if not inventory_serializer.is_valid():
+            error_data = {
+                'status': 'error',
+                'message': 'Invalid request parameters',
+                'errors': inventory_serializer.errors
+            }
+            return Response(error_data, status=status.HTTP_400_BAD_REQUEST)
+        
+        params = inventory_serializer.validated_data
+        
+        try:
+            inventory = CacheManager.inventory(params['cursor'], params['count'])
+        except Exception as e:
+            logger.error(f"Cache inventory error: {str(e)}")
+            return Response({
+                'status': 'error',
+                'message': 'Unable to read cache inventory',
+                'code': 'SERVER_ERROR'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        
+        return Response({
+            'status': 'success',
+            'data': inventory
+        }, status=status.HTTP_200_OK)
+
+
+class CacheInvalidateAPIView(APIView):
+    # API endpoint for namespace-versioned cache invalidation (admin only)
+    # POST /api/v1/cache/invalidate  {"all": true} | {"country": "IN"} | {"prefix": "new"}
+    
+    permission_classes = [IsAdminUser]
+    
+    def post(self, request):
+        # Handle POST request for cache invalidation
+        
+        invalidate_serializer = CacheInvalidateSerializer(data=request.data)
+        if not invalidate_serializer.is_valid():
+            error_data = {
+                'status': 'error',
+                'message': 'Invalid request parameters',
+                'errors': invalidate_serializer.errors
+            }
+            return Response(error_data, status=status.HTTP_400_BAD_REQUEST)
+        
+        params = invalidate_serializer.validated_data
+        
+        if params.get('country'):
+            CacheManager.invalidate_country(params['country'])
+            message = f"Cache invalidated for country '{params['country']}'"
+        elif params.get('prefix'):
+            CacheManager.invalidate_prefix(params['prefix'])
+            message = f"Cache invalidated for cities starting with '{params['prefix']}'"
+        else:
+            CacheManager.clear_all()
+            message = 'All cached cities invalidated'
+        
+        return Response({
+            'status': 'success',
+            'message': message
+        }, status=status.HTTP_200_OK)
+
+
 class HealthCheckAPIView(APIView):
     # Health check endpoint
     # GET /api/v1/health
@@ -153,6 +589,7 @@ class HealthCheckAPIView(APIView):
             'status': 'healthy',
             'api_key_configured': api_key_configured,
             'cache_enabled': True,
+            'upstream_hedging': OpenWeatherService.get_hedge_stats(),
             'timestamp': int(time.time())
         }
         
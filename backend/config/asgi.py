@@ -7,10 +7,60 @@ For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
 
+import asyncio
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from django.core.handlers.asgi import ASGIHandler
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
-application = get_asgi_application()
+
+class DisconnectAwareASGIHandler(ASGIHandler):
+    """
+    ASGI handler that stops serving a request once the client disconnects.
+
+    Django 4.2 reads ``receive()`` only for the request body, so an endless
+    streaming response (the SSE stream) keeps running after the client has
+    gone. Once the body is read, this handler listens for ``http.disconnect``
+    and cancels the request, which closes the response iterator. Django 5.0
+    does the same natively.
+    """
+
+    async def handle(self, scope, receive, send):
+        body_read = asyncio.Event()
+
+        async def receive_body():
+            message = await receive()
+            if message['type'] == 'http.disconnect' or not message.get('more_body', False):
+                body_read.set()
+            return message
+
+        async def listen_for_disconnect():
+            await body_read.wait()
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+
+        tasks = [
+            asyncio.create_task(super().handle(scope, receive_body, send)),
+            asyncio.create_task(listen_for_disconnect()),
+        ]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                    try:
+                        await task
+                    except asyncio.CancelledError:
+                        pass
+        # Surface errors raised while serving the request
+        if tasks[0].done() and not tasks[0].cancelled():
+            tasks[0].result()
+
+
+django.setup(set_prefix=False)
+application = DisconnectAwareASGIHandler()
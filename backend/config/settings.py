@@ -140,16 +140,19 @@ CORS_ALLOW_METHODS = [
 
 # Cache Configuration
 # Try Redis first, fallback to local memory cache if Redis is not available
+REDIS_URL = config('REDIS_URL', default='redis://127.0.0.1:6379/1')
+
 try:
     import redis
-    redis_client = redis.from_url(config('REDIS_URL', default='redis://127.0.0.1:6379/1'))
+    redis_client = redis.from_url(REDIS_URL)
     redis_client.ping()
     
     # Redis is available
+    REDIS_AVAILABLE = True
     CACHES = {
         'default': {
             'BACKEND': 'django_redis.cache.RedisCache',
-            'LOCATION': config('REDIS_URL', default='redis://127.0.0.1:6379/1'),
+            'LOCATION': REDIS_URL,
             'OPTIONS': {
                 'CLIENT_CLASS': 'django_redis.client.DefaultClient',
                 'MAX_ENTRIES': config('MAX_CACHE_ENTRIES', default=1000, cast=int),
@@ -160,6 +163,7 @@ try:
     }
 except (redis.ConnectionError, redis.RedisError, Exception):
     # Redis not available, use local memory cache
+    REDIS_AVAILABLE = False
     CACHES = {
         'default': {
             'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
@@ -177,5 +181,31 @@ OPENWEATHER_BASE_URL = 'https://api.openweathermap.org'
 OPENWEATHER_GEO_URL = f'{OPENWEATHER_BASE_URL}/geo/1.0'
 OPENWEATHER_POLLUTION_URL = f'{OPENWEATHER_BASE_URL}/data/2.5'
 
+# Upstream request tuning (timeouts in seconds)
+UPSTREAM_REQUEST_DEADLINE = config('UPSTREAM_REQUEST_DEADLINE', default=15.0, cast=float)  # all calls for one city
+UPSTREAM_TIMEOUT_MAX = config('UPSTREAM_TIMEOUT_MAX', default=10.0, cast=float)
+UPSTREAM_TIMEOUT_MIN = config('UPSTREAM_TIMEOUT_MIN', default=1.0, cast=float)
+UPSTREAM_TIMEOUT_MULTIPLIER = config('UPSTREAM_TIMEOUT_MULTIPLIER', default=3.0, cast=float)  # x observed p99
+UPSTREAM_HEDGING_ENABLED = config('UPSTREAM_HEDGING_ENABLED', default=True, cast=bool)
+UPSTREAM_RATE_LIMIT_PER_MINUTE = config('UPSTREAM_RATE_LIMIT_PER_MINUTE', default=60, cast=int)
+UPSTREAM_LATENCY_WINDOW = 200  # samples kept per endpoint
+UPSTREAM_LATENCY_MIN_SAMPLES = 20  # before adaptive timeouts and hedging kick in
+UPSTREAM_MAX_CONCURRENCY = 16
+
 # Custom Settings
 CACHE_STATS_ENABLED = True
+
+# Stale data is kept this many seconds past CACHE_TTL and served while a refresh runs
+CACHE_STALE_TTL = config('CACHE_STALE_TTL', default=3600, cast=int)
+
+# Background refresh queue (python manage.py refresh_worker)
+REFRESH_WAIT_TIMEOUT = config('REFRESH_WAIT_TIMEOUT', default=3.0, cast=float)  # seconds a search waits for a queued fetch
+REFRESH_WORKER_CONCURRENCY = config('REFRESH_WORKER_CONCURRENCY', default=4, cast=int)
+REFRESH_JOB_TTL = config('REFRESH_JOB_TTL', default=300, cast=int)  # seconds a pending job blocks duplicates; keep above the expected queue delay
+REFRESH_ERROR_TTL = 30  # seconds an upstream error is reported to waiters
+
+# Server-Sent Events stream (served by the ASGI application)
+STREAM_REFRESH_INTERVAL = config('STREAM_REFRESH_INTERVAL', default=300, cast=int)  # seconds between upstream refreshes per city
+STREAM_HEARTBEAT_INTERVAL = config('STREAM_HEARTBEAT_INTERVAL', default=15, cast=int)
+STREAM_MAX_CITIES = config('STREAM_MAX_CITIES', default=10, cast=int)
+STREAM_MAX_LIFETIME = config('STREAM_MAX_LIFETIME', default=3600, cast=int)  # seconds before a stream closes and the client reconnects
@@ -45,13 +45,33 @@ apiClient.interceptors.response.use(
 
 /**
  * Search for air quality data by city name
+ * Retries while the backend reports the upstream fetch as pending (202)
  * @param {string} cityName - Name of the city
+ * @param {number} retries - Remaining retries for pending responses
  * @returns {Promise} API response with air quality data
+ * @throws {Error} With the pending response attached once retries run out
  */
-export const searchCity = async (cityName) => {
+export const searchCity = async (cityName, retries = 5) => {
   const response = await apiClient.get('/search', {
     params: { city: cityName },
   });
+  if (response.data.status === 'pending') {
+    if (retries > 0) {
+      const delay = (response.data.retry_after || 1) * 1000;
+      await new Promise((resolve) => setTimeout(resolve, delay));
+      return searchCity(cityName, retries - 1);
+    }
+    // Same shape as an axios error, so callers read response.data.message
+    const error = new Error('Air quality data is still being fetched');
+    error.response = {
+      ...response,
+      data: {
+        ...response.data,
+        message: 'Air quality data is taking longer than usual to load. Please try again in a moment.',
+      },
+    };
+    throw error;
+  }
   return response.data;
 };
 